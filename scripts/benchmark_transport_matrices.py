@@ -0,0 +1,328 @@
+"""
+Benchmarks the stages of generate_transport_matrices.py on synthetic networks, without the OSM
+shapefiles: grids and random geometric graphs whose links are split into chains of degree-2
+segments, like the OSM ways, with synthetic centroids.
+
+Every stage is timed (wall and CPU time) and its peak Python memory is traced with tracemalloc.
+The routing backends are cross-checked against the NetworkX reference on the same inputs, and
+the results are written as JSON, one record per network and stage, with the git revision of the
+code, so runs of different versions can be compared.
+
+Example:
+python benchmark_transport_matrices.py --kinds grid rgg --sizes 20 40 80 --centroids 100 --output benchmark.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import scipy
+import networkx as nx
+from scipy.spatial import cKDTree
+
+import generate_transport_matrices as gtm
+
+
+def split_into_chains(starts, ends, chain_points, jitter, rng):
+    """
+    Splits every link into chain_points + 1 straight segments through jittered intermediate points.
+
+    Returns:
+    - lines: Array of LineStrings of the segments.
+    - link: Index of the link of every segment.
+    """
+
+    steps = np.linspace(0, 1, chain_points + 2)
+    points = starts[:, None, :] + (ends - starts)[:, None, :] * steps[None, :, None]
+    points[:, 1:-1] += rng.normal(scale=jitter, size=points[:, 1:-1].shape)
+    coords = np.stack([points[:, :-1], points[:, 1:]], axis=2).reshape(-1, 2, 2)
+    return shapely.linestrings(coords), np.repeat(np.arange(len(starts)), chain_points + 1)
+
+
+
+
+def links_to_gdf(starts, ends, chain_points, rng, speeds=(50, 70, 90, 120), missing_speed=0.1):
+    """
+    Builds the network GeoDataFrame of the links in EPSG:3035 with 'maxspeed' strings as in the
+    OSM shapefiles (missing for a share of the links).
+    """
+
+    jitter = 0.02 * np.median(np.linalg.norm(ends - starts, axis=1))
+    lines, link = split_into_chains(starts, ends, chain_points, jitter, rng)
+    link_speed = rng.choice(speeds, len(starts)).astype(object)
+    link_speed[rng.random(len(starts)) < missing_speed] = None
+    maxspeed = [None if speed is None else str(speed) for speed in link_speed[link]]
+    return gpd.GeoDataFrame({'maxspeed': maxspeed}, geometry=lines, crs=3035)
+
+
+
+
+def make_grid_network(n, spacing=2000.0, chain_points=3, drop=0.1, seed=0):
+    """
+    Generates a road-like grid of n x n junctions whose links (a share drop of them removed) are
+    chains of chain_points degree-2 nodes.
+    """
+
+    rng = np.random.default_rng(seed)
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    nodes = np.column_stack([i.ravel(), j.ravel()]) * spacing + (4.0e6, 3.0e6)
+    ids = np.arange(n * n).reshape(n, n)
+    pairs = np.concatenate([np.column_stack([ids[:-1].ravel(), ids[1:].ravel()]),
+                            np.column_stack([ids[:, :-1].ravel(), ids[:, 1:].ravel()])])
+    pairs = pairs[rng.random(len(pairs)) >= drop]
+    return links_to_gdf(nodes[pairs[:, 0]], nodes[pairs[:, 1]], chain_points, rng)
+
+
+
+
+def make_random_geometric_network(n, extent=100000.0, degree=3.0, chain_points=3, seed=0):
+    """
+    Generates a rail-like random geometric graph: n junctions uniformly in a square, linked when
+    closer than the radius giving the mean degree, with links as chains of degree-2 nodes. Crossing
+    links are split at their intersections by the noding of prepare_network_shapefile.
+    """
+
+    rng = np.random.default_rng(seed)
+    nodes = rng.random((n, 2)) * extent + (4.0e6, 3.0e6)
+    radius = extent * np.sqrt(degree / (np.pi * n))
+    pairs = cKDTree(nodes).query_pairs(radius, output_type='ndarray')
+    return links_to_gdf(nodes[pairs[:, 0]], nodes[pairs[:, 1]], chain_points, rng)
+
+
+
+
+def make_centroids(gdfNet, k, seed=0):
+    """
+    Generates k centroids uniformly within the extent of the network, with 'JPT_KOD_JE' codes.
+    """
+
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = gdfNet.total_bounds
+    xs = xmin + rng.random(k) * (xmax - xmin)
+    ys = ymin + rng.random(k) * (ymax - ymin)
+    return gpd.GeoDataFrame({'JPT_KOD_JE': [f"{i:04d}" for i in range(k)]}, geometry=gpd.points_from_xy(xs, ys), crs=3035)
+
+
+
+
+# Whether measure traces the memory of the stages; tracing slows down Python-heavy stages
+TRACE_MEMORY = True
+
+
+def measure(records, network, stage, function, *args, **kwargs):
+    """
+    Runs one stage, records its wall time, CPU time and peak traced memory, and returns its result.
+    """
+
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function(*args, **kwargs)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak = None
+    if TRACE_MEMORY:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    records.append({**network, 'stage': stage, 'wall_s': wall, 'cpu_s': cpu, 'peak_mb': peak})
+    print(f"\t{stage}: {wall:.3f} s" + (f", {peak:.1f} MB" if peak is not None else ""))
+    return result
+
+
+
+
+def git_revision():
+    """
+    Returns the git revision of the benchmarked code.
+
+    Returns:
+    - revision: Dictionary with the 'commit' (output of git rev-parse HEAD) and 'dirty' (True if the
+      working tree has uncommitted changes), both None if git or the repository is not available.
+    """
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain'], cwd=cwd, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': bool(status.strip())}
+
+
+
+
+def check_cache_key(gdfCentroids):
+    """
+    Checks that the cache key of a layer given with its .shp extension changes when only its
+    attributes (the .dbf) are edited, as for the zone layers of run_zone_scenario.
+
+    Returns:
+    - passed: True if the key changes.
+    """
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'zones.shp')
+        gdfCentroids.to_file(path)
+        key = gtm.network_cache_key([path], {})
+        gdfEdited = gdfCentroids.copy()
+        gdfEdited['JPT_KOD_JE'] = gdfEdited['JPT_KOD_JE'].iloc[::-1].to_numpy()
+        gdfEdited.to_file(path)
+        passed = gtm.network_cache_key([path], {}) != key
+
+    print(f"Cache key check: {'passed' if passed else 'FAILED, an edited .dbf keeps the key'}")
+    return passed
+
+
+
+
+def max_difference(matrix, reference):
+    """
+    Returns the largest absolute difference between two travel time matrices, or np.inf if
+    they disagree on which pairs are connected.
+    """
+
+    finite = np.isfinite(reference)
+    if not np.array_equal(finite, np.isfinite(matrix)):
+        return np.inf
+    return float(np.max(np.abs(matrix[finite] - reference[finite]), initial=0.0))
+
+
+
+
+def benchmark_network(gdfNet, gdfCentroids, network, n_workers=1, reference_centroids=50, tolerance=1e-9, n_tiles=8):
+    """
+    Runs and measures every stage of the pipeline on one synthetic network.
+
+    Besides the stages of one scenario, the tiled noding (n_tiles tiles, 0 to skip it) is compared
+    with the global noding, and a speed parameter sweep of 8 sets is run, whose first set (the speeds
+    of the network) is checked against the NetworkX reference.
+
+    Returns:
+    - records: List of dictionaries, one per stage, with the network description, the timings,
+      the sizes and, for the routing stages, the difference to the NetworkX reference.
+    """
+
+    records = []
+
+    def upload():
+        gdf = gdfNet.copy()
+        gdf["maxspeed"] = pd.to_numeric(gdf["maxspeed"], errors='coerce')
+        gdf["speed_is_default"] = gdf["maxspeed"].isna()
+        gdf.loc[gdf["maxspeed"].isna(), "maxspeed"] = 56
+        return gdf
+
+    gdf = measure(records, network, 'upload', upload)
+    gdf = measure(records, network, 'prepare_network_shapefile', gtm.prepare_network_shapefile, gdf)
+    records[-1]['segments'] = len(gdf)
+    if n_tiles:
+        gdfTiled = measure(records, network, 'prepare_network_shapefile_tiled', gtm.prepare_network_shapefile, upload(),
+                           n_tiles=n_tiles, n_workers=n_workers)
+        length_difference = abs(gdfTiled.length.sum() - gdf.length.sum()) / gdf.length.sum()
+        records[-1].update(tiles=n_tiles, segments=len(gdfTiled), length_difference=float(length_difference),
+                           matches_reference=bool(len(gdfTiled) == len(gdf) and length_difference <= 1e-6))
+        if not records[-1]['matches_reference']:
+            print(f"\tWarning: the tiled noding gives {len(gdfTiled)} segments instead of {len(gdf)}.")
+    gdfConnections, codes = measure(records, network, 'prepare_centroids_for_conversion_into_graph',
+                                    gtm.prepare_centroids_for_conversion_into_graph, gdf, gdfCentroids)
+    arrays = measure(records, network, 'create_graph_arrays', gtm.create_graph_arrays, gdf, gdfConnections, codes)
+    records[-1].update(nodes=len(arrays['nodes']), edges=len(arrays['u']))
+    G = measure(records, network, 'create_nx_graph', gtm.create_nx_graph, gdf, gdfConnections, codes)
+    H = measure(records, network, 'contract_degree_two_chains', gtm.contract_degree_two_chains, G)
+    records[-1].update(nodes=H.number_of_nodes(), edges=H.number_of_edges())
+
+    # The NetworkX reference runs on a subset of the sources, as it is the slow path
+    subset = codes[:reference_centroids]
+    reference = measure(records, network, 'matrix_networkx', gtm.compute_travel_time_matrix, G, subset, codes, backend='networkx')
+    records[-1]['sources'] = len(subset)
+
+    checks = [
+        ('matrix_csgraph', lambda: gtm.compute_travel_time_matrix(arrays, codes, codes, n_workers=n_workers)),
+        ('matrix_csgraph_contracted', lambda: gtm.compute_travel_time_matrix(H, codes, codes, n_workers=n_workers)),
+        ('matrix_csgraph_symmetric', lambda: gtm.compute_travel_time_matrix(H, codes, codes, n_workers=n_workers, symmetric=True)),
+        ('routing_matrices', lambda: gtm.compute_routing_matrices(H, codes, codes, return_predecessors=True, n_workers=n_workers)['travel_time']),
+    ]
+    for stage, run in checks:
+        matrix = measure(records, network, stage, run)
+        difference = max_difference(matrix[:len(subset)], reference)
+        records[-1].update(sources=len(codes), max_difference=difference, matches_reference=bool(difference <= tolerance))
+        if difference > tolerance:
+            print(f"\tWarning: {stage} differs from the NetworkX reference by {difference}.")
+
+    # The first parameter set keeps the speeds of the network, so it matches the reference
+    parameter_sets = gtm.speed_parameter_grid(default_speed=[None, 40, 56, 70], connector_speed=[30, 20])
+    sweep = measure(records, network, 'sweep_travel_time_matrices', gtm.sweep_travel_time_matrices,
+                    gdf, gdfConnections, codes, parameter_sets, n_workers=n_workers, dtype=np.float64)
+    difference = max_difference(sweep['travel_time'][0][:len(subset)], reference)
+    records[-1].update(sources=len(codes), parameter_sets=len(parameter_sets), max_difference=difference,
+                       matches_reference=bool(difference <= tolerance))
+    if difference > tolerance:
+        print(f"\tWarning: sweep_travel_time_matrices differs from the NetworkX reference by {difference}.")
+
+    return records
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the travel time matrix pipeline on synthetic networks.")
+    parser.add_argument('--kinds', nargs='+', default=['grid', 'rgg'], choices=['grid', 'rgg'], help="Network generators")
+    parser.add_argument('--sizes', nargs='+', type=int, default=[20, 40],
+                        help="Grid side (grid) or number of junctions / 10 (rgg)")
+    parser.add_argument('--chain-points', type=int, default=3, help="Degree-2 nodes per link")
+    parser.add_argument('--centroids', type=int, default=50, help="Number of synthetic centroids")
+    parser.add_argument('--reference-centroids', type=int, default=20, help="Sources computed with the NetworkX reference")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes of the csgraph backend")
+    parser.add_argument('--tiles', type=int, default=8, help="Tiles of the tiled noding stage (0 to skip it)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-trace-memory', action='store_true', help="Only time the stages (tracemalloc slows them down)")
+    parser.add_argument('--output', default='benchmark_transport_matrices.json', help="JSON file of the results")
+    args = parser.parse_args()
+
+    global TRACE_MEMORY
+    TRACE_MEMORY = not args.no_trace_memory
+
+    checks = {'cache_key_dbf': check_cache_key(make_centroids(make_grid_network(3), 5, seed=args.seed))}
+
+    results = []
+    for kind in args.kinds:
+        for size in args.sizes:
+            if kind == 'grid':
+                gdfNet = make_grid_network(size, chain_points=args.chain_points, seed=args.seed)
+            else:
+                gdfNet = make_random_geometric_network(10 * size, chain_points=args.chain_points, seed=args.seed)
+            gdfCentroids = make_centroids(gdfNet, args.centroids, seed=args.seed)
+            network = {'kind': kind, 'size': size, 'chain_points': args.chain_points, 'centroids': args.centroids, 'lines': len(gdfNet)}
+
+            print(f"Benchmarking {kind} network of size {size} ({len(gdfNet)} lines)")
+            results.extend(benchmark_network(gdfNet, gdfCentroids, network, n_workers=args.workers,
+                                             reference_centroids=args.reference_centroids, n_tiles=args.tiles))
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'git': git_revision(),
+        'versions': {'numpy': np.__version__, 'scipy': scipy.__version__, 'networkx': nx.__version__,
+                     'geopandas': gpd.__version__, 'shapely': shapely.__version__},
+        'cpu_count': os.cpu_count(),
+        'arguments': vars(args),
+        'checks': checks,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
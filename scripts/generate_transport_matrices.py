@@ -8,31 +8,229 @@ pip install geopandas
 pip install shapely
 pip install networkx
 pip install matplotlib
+pip install scipy
+pip install pyarrow (optional, for the cache of prepared networks and the Arrow-based reading)
+pip install pyogrio (optional, reads only the needed columns of the shapefiles)
+pip install psutil (optional, peak memory in the run report on Windows)
+
+The scenarios are listed in scenarios.json; the paths default to the shape, data/input and figs
+directories of the repository. Examples:
+python generate_transport_matrices.py --list
+python generate_transport_matrices.py --scenario poland-highway-future --plots path,counties
+python generate_transport_matrices.py --scenario poland-railway-future --no-plots --workers 16 --report run.json
+python generate_transport_matrices.py --scenario poland-railway-future --no-plots --zones gminy.shp --zone-id JPT_KOD_JE --zone-weight population
 
 """
 
+import argparse
+import cProfile
+import errno
+import hashlib
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
 import numpy as np
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import LineString, Point
-from shapely.ops import nearest_points, unary_union
-import networkx as nx
-import matplotlib.pyplot as plt
+from scipy.sparse import coo_matrix, csr_matrix, issparse
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import squareform
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def _lazy_import(name):
+    """
+    Returns the module name, executed only when one of its attributes is first used. The heavy
+    geospatial modules are imported this way, so the command line starts fast; matplotlib is
+    imported by the plotting functions only, so runs without plots never load it.
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'")
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+pd = _lazy_import('pandas')
+gpd = _lazy_import('geopandas')
+shapely = _lazy_import('shapely')
+nx = _lazy_import('networkx')
+
+
+# Upper bound on the number of float64 distances kept in memory by one multi-source
+# Dijkstra call (2**25 values take 256 MB); the number of sources per batch is derived from it.
+DIJKSTRA_BLOCK_SIZE = 2**25
+
+# Number of already computed rows used to bound the searches of the symmetric mode
+SYMMETRIC_LANDMARKS = 16
+
+# Relative slack added to the search limits derived from computed (possibly float32) distances
+LIMIT_SLACK = 1e-6
+
+# Version of the prepared network cache; bump it when the preparation steps change their output
+CACHE_VERSION = 6
+
+# File marking a published cache entry; only entries with it are evicted
+CACHE_MANIFEST = 'entry.json'
+
+# Component files of a shapefile hashed by network_cache_key
+SHAPEFILE_EXTENSIONS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+def read_layer(file_path, columns=None, bbox=None, mask=None, crs=3035, cache_dir=None):
+    """
+    Reads a vector layer with only the needed attribute columns, optionally restricted to a region,
+    and reprojects it once.
+
+    With pyogrio (and pyarrow) the layer is read through Arrow and only the requested columns are
+    decoded; otherwise gpd.read_file reads all columns and the others are dropped afterwards. The
+    region filter is applied by the reader, in the CRS of the layer, so features outside it are never
+    loaded. With cache_dir, the reprojected result is stored as GeoParquet, keyed by the contents of
+    the file and the read parameters, and later runs read it back instead of the file.
+
+    Parameters:
+    - file_path: Path of the layer (e.g. a shapefile).
+    - columns: Attribute columns to keep; None keeps all of them.
+    - bbox: Optional bounding box (xmin, ymin, xmax, ymax) in crs; only the features intersecting it are read.
+    - mask: Optional region (a shapely geometry in crs, or a GeoSeries/GeoDataFrame with its own CRS);
+      only the features intersecting it are read. Cannot be combined with bbox.
+    - crs: CRS of the returned GeoDataFrame (and of bbox and a geometry mask).
+    - cache_dir: Optional directory of the GeoParquet cache (shared with the prepared network cache).
+
+    Returns:
+    - gdf: GeoDataFrame with the geometry and the requested columns in crs.
+    """
+
+    if bbox is not None and mask is not None:
+        raise ValueError("Use either bbox or mask, not both.")
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(errno.ENOENT, "No such file or directory", file_path)
+
+    key = None
+    if cache_dir is not None:
+        params = {'layer': os.path.basename(file_path), 'columns': columns, 'bbox': bbox, 'crs': crs,
+                  'mask': None if mask is None else shapely.to_wkt(mask) if isinstance(mask, shapely.Geometry) else mask.to_json()}
+        key = 'layer-' + network_cache_key([file_path], params)
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry):
+            try:
+                gdf = gpd.read_parquet(os.path.join(entry, 'layer.parquet'))
+                os.utime(entry)
+                return gdf
+            except ImportError as e:
+                print(f"Cache disabled: {e}")
+                key = None
+
+    # A region in crs is reprojected to the layer CRS with straight edges, so a slightly larger,
+    # densified region is read and the features are selected exactly after the reprojection
+    region, select = None, None
+    if bbox is not None:
+        select = shapely.box(*bbox)
+    elif isinstance(mask, shapely.Geometry):
+        select = mask
+    elif mask is not None:
+        region = mask
+    if select is not None:
+        xmin, ymin, xmax, ymax = select.bounds
+        margin = 0.01 * max(xmax - xmin, ymax - ymin, 1.0)
+        region = gpd.GeoSeries([shapely.segmentize(select.buffer(margin, join_style='mitre'), margin)], crs=crs)
+
+    read_kwargs = {}
+    try:
+        import pyogrio  # noqa: F401
+        read_kwargs = {'engine': 'pyogrio', 'columns': columns}
+        import pyarrow  # noqa: F401
+        read_kwargs['use_arrow'] = True
+    except ImportError:
+        pass
+
+    gdf = gpd.read_file(file_path, mask=region, **read_kwargs)
+    if columns is not None:
+        gdf = gdf[list(columns) + [gdf.geometry.name]]
+    gdf = gdf.to_crs(epsg=crs)
+    if select is not None:
+        gdf = gdf[gdf.intersects(select)].reset_index(drop=True)
+
+    if key is not None:
+        try:
+            entry_tmp = tempfile.mkdtemp(prefix=key + '.', dir=_makedirs(cache_dir))
+            gdf.to_parquet(os.path.join(entry_tmp, 'layer.parquet'))
+            publish_cache_entry(cache_dir, key, entry_tmp)
+        except ImportError as e:
+            print(f"Cache disabled: {e}")
+
+    return gdf
+
 
 
-def upload_centroids(root_path):
+
+def upload_centroids(root_path, bbox=None, mask=None, cache_dir=None):
     print("Loading centroids")
     try:
-        gdfCentroids = gpd.read_file(root_path + "powiaty_centroids.shp")
+        gdfCentroids = read_layer(root_path + "powiaty_centroids.shp", columns=['JPT_KOD_JE'], bbox=bbox, mask=mask, cache_dir=cache_dir)
     except FileNotFoundError:
         print(f"File not found: {root_path + 'powiaty_centroids.shp'}")
-    gdfCentroids = gdfCentroids.to_crs(epsg=3035)
+        raise
     return gdfCentroids
 
+
+
+
+def upload_zones(file_path, id_column, columns=(), bbox=None, mask=None, cache_dir=None):
+    """
+    Loads any zone layer (e.g. gminas, grid cells or station catchments) as the centroids of the graph.
+
+    Parameters:
+    - file_path: Path of the point or polygon layer.
+    - id_column: Column with the unique zone IDs, used in place of 'JPT_KOD_JE'.
+    - columns: Further columns to read, e.g. the population used as the aggregation weight.
+    - bbox, mask, cache_dir: As in read_layer.
+
+    Returns:
+    - gdfZones: GeoDataFrame in EPSG:3035 with the id and further columns and one point per zone
+      (the representative point of polygon zones).
+    """
+
+    print("Loading zones")
+    gdfZones = read_layer(file_path, columns=[id_column, *columns], bbox=bbox, mask=mask, cache_dir=cache_dir)
+    if gdfZones[id_column].duplicated().any():
+        raise ValueError(f"The zone IDs in the '{id_column}' column of {file_path} are not unique.")
+    gdfZones['geometry'] = gdfZones.geometry.representative_point()
+    print(f"\tZones: {len(gdfZones)}.")
+    return gdfZones
+
 def plot_gdf(gdf, output_file):
     """
     Plots the provided shapefile and saves the plot to the output file.
     """
+
+    import matplotlib.pyplot as plt
     
     # Create the plot
     ax = gdf.plot(color='pink')
@@ -44,15 +242,16 @@ def plot_gdf(gdf, output_file):
 
 
   
-def upload_shapefile(file, default_speed, root_path):
+def upload_shapefile(file, default_speed, root_path, columns=(), bbox=None, mask=None, cache_dir=None):
     print("Loading shapefile")
     try: 
-        gdfNet = gpd.read_file(root_path + file + ".shp")
+        gdfNet = read_layer(root_path + file + ".shp", columns=['maxspeed', *columns], bbox=bbox, mask=mask, cache_dir=cache_dir)
     except FileNotFoundError:
         print(f"File not found: {root_path + file + '.shp'}")
+        raise
 
-    gdfNet = gdfNet.to_crs(epsg=3035)
     gdfNet["maxspeed"] = pd.to_numeric(gdfNet["maxspeed"], errors='coerce')
+    gdfNet["speed_is_default"] = gdfNet["maxspeed"].isna() | (gdfNet["maxspeed"]==0)  # For the speed parameter sweeps
     gdfNet.loc[gdfNet["maxspeed"].isna(), "maxspeed"] = default_speed
     gdfNet.loc[gdfNet["maxspeed"]==0, "maxspeed"] = default_speed
 
@@ -63,19 +262,192 @@ def upload_shapefile(file, default_speed, root_path):
 
 
 
-def prepare_network_shapefile(gdfNet):
+def largest_component_mask(geometries):
+    """
+    Marks the geometries that are part of the largest connected component of the network.
+
+    Consecutive vertices of every LineString are connected; vertices with equal coordinates are
+    the same node. All vertices are interned to integer ids at once, the components are found
+    with scipy, and a geometry belongs to the largest component if any of its vertices does.
+
+    Parameters:
+    - geometries: GeoSeries of the network geometries.
+
+    Returns:
+    - mask: Boolean NumPy array, True for the geometries in the largest connected component.
+    """
+
+    geometries = np.asarray(geometries)
+    coords, owner = shapely.get_coordinates(geometries, return_index=True)
+    if len(coords) == 0:
+        return np.zeros(len(geometries), dtype=bool)
+
+    # Intern the vertices to integer ids
+    unique_coords, first_seen, vertex = np.unique(coords, axis=0, return_index=True, return_inverse=True)
+    vertex = vertex.ravel()
+
+    # Connect consecutive vertices of the same LineString
+    is_line = shapely.get_type_id(geometries) == shapely.GeometryType.LINESTRING
+    consecutive = (owner[1:] == owner[:-1]) & is_line[owner[:-1]]
+    u, v = vertex[:-1][consecutive], vertex[1:][consecutive]
+    n_vertices = len(unique_coords)
+    adjacency = csr_matrix((np.ones(len(u), dtype=np.int8), (u, v)), shape=(n_vertices, n_vertices))
+    n_components, labels = connected_components(adjacency, directed=False)
+
+    # Only vertices on an edge are graph nodes; ties are broken by the first node seen, as with NetworkX
+    on_edge = np.zeros(n_vertices, dtype=bool)
+    on_edge[u] = True
+    on_edge[v] = True
+    sizes = np.bincount(labels[on_edge], minlength=n_components)
+    candidates = np.flatnonzero(sizes == sizes.max())
+    if len(candidates) > 1:
+        first_in_component = np.full(n_components, len(coords))
+        np.minimum.at(first_in_component, labels[on_edge], first_seen[on_edge])
+        largest = candidates[np.argmin(first_in_component[candidates])]
+    else:
+        largest = candidates[0]
+
+    in_largest = on_edge[vertex] & (labels[vertex] == largest)
+    return np.bincount(owner, weights=in_largest, minlength=len(geometries)) > 0
+
+
+
+
+# Buffer used to match the noded pieces back to the original network rows (float arithmetic correction)
+NODING_BUFFER = 0.01
+
+
+def _node_lines(gdfLines, keep_piece):
+    """
+    Nodes the lines with unary_union and matches the pieces selected by keep_piece(bounds)
+    back to the lines they lie within, carrying over their attributes.
+    """
+
+    pieces = shapely.get_parts(shapely.union_all(np.asarray(gdfLines.geometry)))
+    pieces = pieces[keep_piece(shapely.bounds(pieces))]
+    pieces = gpd.GeoDataFrame({'id': np.arange(len(pieces)), 'geometry': pieces}, crs=gdfLines.crs)
+    gdfBuffered = gdfLines.copy()
+    gdfBuffered.geometry = gdfBuffered.geometry.buffer(NODING_BUFFER)
+    return gpd.sjoin(pieces, gdfBuffered, how='inner', predicate='within')
+
+
+def _node_tile(gdfLines, tile):
+    """
+    Nodes the lines intersecting one tile and keeps the pieces that lie inside the tile.
+    """
+
+    xmin, ymin, xmax, ymax = tile
+    return _node_lines(gdfLines, lambda b: (b[:, 0] >= xmin) & (b[:, 1] >= ymin) & (b[:, 2] <= xmax) & (b[:, 3] <= ymax))
+
+
+def _in_single_tile(bounds, xs, ys):
+    """
+    Tells whether each bounding box lies inside a single (closed) tile of the grid.
+    """
+
+    col = np.clip(np.searchsorted(xs, bounds[:, 0], side='right') - 1, 0, len(xs) - 2)
+    row = np.clip(np.searchsorted(ys, bounds[:, 1], side='right') - 1, 0, len(ys) - 2)
+    return (bounds[:, 2] <= xs[col + 1]) & (bounds[:, 3] <= ys[row + 1])
+
+
+
+
+def node_network_tiled(gdfNet, n_tiles=8, n_workers=1):
+    """
+    Splits the network at all intersections tile by tile instead of with one global unary_union.
+
+    The network extent is divided into n_tiles x n_tiles tiles. Every tile nodes the lines that
+    intersect it and keeps the pieces lying inside it: all intersections inside a tile involve
+    only those lines, so these pieces are exactly the pieces of the global noding. The pieces that
+    cross tile boundaries belong to the few lines crossing them; these lines are noded once more
+    together with every line that intersects them, which stitches the tiles together. The pieces
+    are matched back to the buffered original rows as in prepare_network_shapefile, so 'maxspeed'
+    and the other attributes are carried over.
+
+    The tiles are noded in parallel with n_workers processes. Only the line indices of every tile are
+    computed up front; the lines of a tile are sliced when it is submitted, and at most 2 * n_workers
+    tiles are in flight at once. Besides the network and its noded pieces, which are both kept, the
+    extra memory is therefore bounded by the tiles in flight and the seam lines, instead of by one
+    global unary_union.
+
+    Parameters:
+    - gdfNet: GeoDataFrame of the network lines.
+    - n_tiles: Number of tiles along each axis.
+    - n_workers: Number of worker processes.
+
+    Returns:
+    - gdfNet: GeoDataFrame of the noded pieces with the columns of the global noding
+      ('id', 'geometry', 'index_right' and the original attributes).
+    """
+
+    xmin, ymin, xmax, ymax = gdfNet.total_bounds
+    xs = np.linspace(xmin, xmax, n_tiles + 1)
+    ys = np.linspace(ymin, ymax, n_tiles + 1)
+    tiles = [(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(n_tiles) for j in range(n_tiles)]
+
+    # Lines intersecting each tile (the query box is expanded by the buffer for the attribute match)
+    sindex = gdfNet.sindex
+    tile_lines = [np.sort(sindex.query(shapely.box(*tile).buffer(2 * NODING_BUFFER, join_style='mitre'), predicate='intersects'))
+                  for tile in tiles]
+    tasks = [(lines, tile) for lines, tile in zip(tile_lines, tiles) if len(lines) > 0]
+
+    # Seam lines: lines crossing a tile boundary, with every line that intersects them
+    crossing = ~_in_single_tile(gdfNet.bounds.to_numpy(), xs, ys)
+    seam = np.unique(sindex.query(np.asarray(gdfNet.geometry)[crossing], predicate='intersects')[1])
+
+    print(f"\tNoding {len(tasks)} tiles and {crossing.sum()} lines crossing tile boundaries.")
+
+    if n_workers > 1:
+        # Submit in order with a bounded number of tiles in flight, instead of all of them at once
+        pieces, in_flight = [], deque()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for lines, tile in tasks:
+                if len(in_flight) >= 2 * n_workers:
+                    pieces.append(in_flight.popleft().result())
+                in_flight.append(executor.submit(_node_tile, gdfNet.iloc[lines], tile))
+            pieces.extend(future.result() for future in in_flight)
+    else:
+        pieces = [_node_tile(gdfNet.iloc[lines], tile) for lines, tile in tasks]
+    if len(seam) > 0:
+        pieces.append(_node_lines(gdfNet.iloc[seam], lambda b: ~_in_single_tile(b, xs, ys)))
+
+    # Pieces lying on a boundary between two tiles are found in both of them
+    gdfPieces = pd.concat(pieces)
+    key = shapely.to_wkb(shapely.normalize(np.asarray(gdfPieces.geometry)))
+    gdfPieces = gdfPieces[~pd.DataFrame({'key': key, 'index_right': gdfPieces['index_right'].to_numpy()}).duplicated().to_numpy()]
+    gdfPieces['id'] = np.arange(len(gdfPieces))
+
+    return gdfPieces.reset_index(drop=True)
+
+
+
+
+def prepare_network_shapefile(gdfNet, n_tiles=None, n_workers=1):
+    """
+    Splits the network at all intersections, keeps its largest connected component and assigns
+    the travel time to each segment.
+
+    With n_tiles set, the network is noded tile by tile (see node_network_tiled) with n_workers
+    processes instead of with one global unary_union.
+    """
+
     print("Preparing network shapefile")
 
     # Step 1: Prepare the transportation network shapefile for conversion into a Graph
     n_segments_before_split = len(gdfNet)
 
     # Fix geometries to avoid issues during graph conversion
-    unary = gdfNet.geometry.unary_union
-    gdfNet.geometry = gdfNet.geometry.buffer(0.01)  # Float arithmetic correction
-    geom = [i for i in unary.geoms]
-    id = [j for j in range(len(geom))]
-    unary = gpd.GeoDataFrame({'id': id, 'geometry': geom}, crs=3035)
-    gdfNet = gpd.sjoin(unary, gdfNet, how='inner', predicate='within')
+    with stage('noding', segments=n_segments_before_split) as record:
+        if n_tiles:
+            gdfNet = node_network_tiled(gdfNet, n_tiles=n_tiles, n_workers=n_workers)
+        else:
+            unary = gdfNet.geometry.unary_union
+            gdfNet.geometry = gdfNet.geometry.buffer(NODING_BUFFER)  # Float arithmetic correction
+            geom = [i for i in unary.geoms]
+            id = [j for j in range(len(geom))]
+            unary = gpd.GeoDataFrame({'id': id, 'geometry': geom}, crs=3035)
+            gdfNet = gpd.sjoin(unary, gdfNet, how='inner', predicate='within')
+        record['segments_after_split'] = len(gdfNet)
 
     n_segments_after_split = len(gdfNet)
 
@@ -83,27 +455,10 @@ def prepare_network_shapefile(gdfNet):
     print(f'\tSegments after split: {n_segments_after_split}.')
 
 
-    # Step 2: Create a graph from the geometries
-    G = nx.Graph()
-
-    # Add edges to the graph based on the LineString geometries
-    for idx, geom in enumerate(gdfNet.geometry):
-        if isinstance(geom, LineString):
-            coords = list(geom.coords)
-            for i in range(len(coords) - 1):
-                G.add_edge(coords[i], coords[i + 1], index=idx)
-
-
-    # Step 3: Identify the largest connected component
-    largest_cc = max(nx.connected_components(G), key=len)
-    
-
-    # Step 4: Filter the GeoDataFrame to keep only the geometries that are part of the largest connected component
-    def is_part_of_largest_cc(geom):
-        coords = list(geom.coords)
-        return any(coord in largest_cc for coord in coords)
-
-    gdfNet = gdfNet[gdfNet.geometry.apply(is_part_of_largest_cc)]
+    # Steps 2-4: Keep only the geometries that are part of the largest connected component
+    with stage('component_filter', segments=n_segments_after_split) as record:
+        gdfNet = gdfNet[largest_component_mask(gdfNet.geometry)]
+        record['segments_after_filtering'] = len(gdfNet)
 
 
     # Step 5: Assign travel time to each segment
@@ -120,42 +475,67 @@ def prepare_network_shapefile(gdfNet):
 
 
 
-def prepare_centroids_for_conversion_into_graph(gdfNet, gdfCentroids):
+def prepare_centroids_for_conversion_into_graph(gdfNet, gdfCentroids, k=1, radius=None, connector_speed=30, id_column='JPT_KOD_JE'):
+    """
+    Connects every centroid with straight lines to its nearest entry points of the network.
 
-    # Assume the entry points to the railway line are all geometry nodes in the line.
-    # It is a simplifying assumption.
+    The endpoints of all network geometries are extracted as arrays and deduplicated with NumPy,
+    and all centroids are answered by one bulk nearest-neighbour query on a KD-tree.
 
-    print("Preparing centroids for conversion into graph")
+    Parameters:
+    - gdfNet: GeoDataFrame of the prepared network.
+    - gdfCentroids: GeoDataFrame of the centroids (or zones, see upload_zones) with the id column.
+    - k: Number of nearest entry points each centroid is connected to. With k > 1 routes may pass
+      through a centroid between two of its entry points at the connector speed.
+    - radius: If set, each centroid is instead connected to all entry points within radius metres
+      (and to the nearest one if there is none).
+    - connector_speed: Speed on the connections in km/h.
+    - id_column: Column of gdfCentroids with the centroid IDs.
 
-    entryPoints = []
-    for geom in gdfNet.geometry:
-        if geom.geom_type == 'Point':
-            entryPoints.append(geom)
-        elif geom.geom_type in ['LineString', 'Polygon']:
-            entryPoints.append(list(geom.coords)[0])
-            entryPoints.append(list(geom.coords)[-1])
-        else:
-            print("None of the three types.")
+    Returns:
+    - gdfConnections: GeoDataFrame of the connections (centroid first) with the position of their
+      centroid in powiaty_codes ('centroid_idx') and the 'travel_time' in minutes.
+    - powiaty_codes: List of the centroid IDs.
+    """
 
-    print("\nCreated entryPoints list.")
+    # Assume the entry points to the railway line are all geometry nodes in the line.
+    # It is a simplifying assumption.
 
-    entryPoints = set(entryPoints)
-    gdfEntryPoints = gpd.GeoDataFrame(geometry=gpd.points_from_xy([tpl[0] for tpl in entryPoints], [tpl[1] for tpl in entryPoints]), crs=3035)
-    powiaty_codes = list(gdfCentroids['JPT_KOD_JE'])
+    print("Preparing centroids for conversion into graph")
 
-    #Use geopandas's sjoin_nearest to find the closest street network vertice for each zonal centroid, then build straight lines.
-    mappingCentroidToNet = gpd.sjoin_nearest(gdfCentroids, gdfEntryPoints, how='left')['index_right'].to_dict()
-    lines = []
-    for centroid, entryPoint in mappingCentroidToNet.items():
-        ptStart = gdfCentroids.loc[centroid, 'geometry']
-        ptEnd = gdfEntryPoints.loc[entryPoint, 'geometry']
-        line = LineString([ptStart, ptEnd])
-        lines.append(line)
+    geoms = np.asarray(gdfNet.geometry)
+    is_point = shapely.get_type_id(geoms) == shapely.GeometryType.POINT
+    entryPoints = np.concatenate([shapely.get_coordinates(geoms[is_point]),
+                                  shapely.get_coordinates(shapely.get_point(geoms[~is_point], 0)),
+                                  shapely.get_coordinates(shapely.get_point(geoms[~is_point], -1))])
+    entryPoints = np.unique(entryPoints, axis=0)
+
+    print(f"\nCreated entryPoints list ({len(entryPoints)} points).")
+
+    powiaty_codes = list(gdfCentroids[id_column])
+    centroids = shapely.get_coordinates(np.asarray(gdfCentroids.geometry))
+
+    # Find the closest network vertices for all zonal centroids at once, then build straight lines.
+    tree = cKDTree(entryPoints)
+    if radius is None:
+        distances, nearest = tree.query(centroids, k=k)
+        nearest = nearest.reshape(len(centroids), -1)
+        centroid_idx = np.repeat(np.arange(len(centroids)), nearest.shape[1])
+        nearest = nearest.ravel()
+        found = nearest < len(entryPoints)  # Fewer entry points than k
+        centroid_idx, nearest = centroid_idx[found], nearest[found]
+    else:
+        within = tree.query_ball_point(centroids, r=radius, return_sorted=True)
+        closest = tree.query(centroids)[1]
+        within = [points if len(points) > 0 else [closest[i]] for i, points in enumerate(within)]
+        centroid_idx = np.repeat(np.arange(len(centroids)), [len(points) for points in within])
+        nearest = np.concatenate(within).astype(np.int64)
 
-    gdfConnections = gpd.GeoDataFrame(geometry=lines, crs=3035)
+    lines = shapely.linestrings(np.stack([centroids[centroid_idx], entryPoints[nearest]], axis=1))
+    gdfConnections = gpd.GeoDataFrame({'centroid_idx': centroid_idx}, geometry=lines, crs=3035)
 
-    # I assume the travel time to the nearest railway access at pace of 30km/h
-    gdfConnections['travel_time'] = ((gdfConnections.length / 1000) / 30) * 60
+    # I assume the travel time to the railway access at pace of 30km/h by default
+    gdfConnections['travel_time'] = ((shapely.length(lines) / 1000) / connector_speed) * 60
 
     return gdfConnections, powiaty_codes
 
@@ -175,6 +555,8 @@ def plot_network_with_connections(gdfNet, gdfConnections, gdfCentroids, file_nam
     - file_name: Optional file name to save the plot. If None, the plot is not saved.
     """
 
+    import matplotlib.pyplot as plt
+
     print("\tPlotting connections.")
     
     # Create the plot
@@ -195,6 +577,7 @@ def plot_network_with_connections(gdfNet, gdfConnections, gdfCentroids, file_nam
     
     # Save the plot to a file if file_name is provided
     plt.savefig(file_name, format='png', bbox_inches='tight')
+    plt.close(fig)
     print(f"\tPlot saved to {file_name}")
 
 
@@ -209,71 +592,299 @@ def check_edges_have_attribute(graph, attribute):
 
 
 
-def create_nx_graph(gdfNet, gdfConnections, powiaty_codes):
+def create_graph_arrays(gdfNet, gdfConnections, powiaty_codes, edge_attributes=()):
+    """
+    Creates the integer edge list of the network and the centroid connections in one bulk pass.
+
+    The endpoints of all LineStrings are extracted with shapely as coordinate arrays and interned
+    to integer node ids; equal coordinates are the same node, as in the NetworkX graph.
+
+    Parameters:
+    - gdfNet: GeoDataFrame of the network segments with a 'travel_time' column.
+    - gdfConnections: GeoDataFrame of the centroid connections (centroid first) with a 'travel_time' column.
+    - powiaty_codes: List of centroid IDs, indexed by the 'centroid_idx' column of gdfConnections
+      (or one per row of gdfConnections if there is no such column).
+    - edge_attributes: Further numeric gdfNet columns carried on the edges, e.g. the km of new lines
+      of a segment. Connections take the column from gdfConnections if it exists there and 0 otherwise.
+
+    Returns:
+    - arrays: Dictionary in the format of graph_to_arrays, with the edge endpoints ('u', 'v'), the
+      'travel_time' of the edges, their 'length' in km and the edge_attributes columns (the names of
+      both listed in 'edge_attributes'), the gdfNet position of network edges ('edge_index', -1 for
+      connections), the gdfConnections position of connections ('connection_idx', -1 for network
+      edges) and the centroid_id -> node id index ('centroid_index').
+    """
+
+    print("Creating graph arrays")
+
+    net_geoms = np.asarray(gdfNet.geometry)
+    conn_geoms = np.asarray(gdfConnections.geometry)
+    net_pos = np.flatnonzero(shapely.get_type_id(net_geoms) == shapely.GeometryType.LINESTRING)
+    conn_pos = np.flatnonzero(shapely.get_type_id(conn_geoms) == shapely.GeometryType.LINESTRING)
+
+    endpoints = np.concatenate([shapely.get_coordinates(shapely.get_point(geoms, k))
+                                for geoms in (net_geoms[net_pos], conn_geoms[conn_pos]) for k in (0, -1)])
+    unique_coords, node = np.unique(endpoints, axis=0, return_inverse=True)
+    node = node.ravel()
+
+    m, k = len(net_pos), len(conn_pos)
+    centroid_idx = gdfConnections['centroid_idx'].to_numpy() if 'centroid_idx' in gdfConnections else np.arange(len(gdfConnections))
+    arrays = {
+        'nodes': list(map(tuple, unique_coords.tolist())),
+        'u': np.concatenate([node[:m], node[2 * m:2 * m + k]]),
+        'v': np.concatenate([node[m:2 * m], node[2 * m + k:]]),
+        'travel_time': np.concatenate([gdfNet['travel_time'].to_numpy(dtype=float)[net_pos],
+                                       gdfConnections['travel_time'].to_numpy(dtype=float)[conn_pos]]),
+        'edge_index': np.concatenate([net_pos, np.full(k, -1)]),
+        'connection_idx': np.concatenate([np.full(m, -1), conn_pos]),
+        'length': np.concatenate([shapely.length(net_geoms[net_pos]), shapely.length(conn_geoms[conn_pos])]) / 1000,
+        'edge_attributes': ('length',) + tuple(edge_attributes),
+        'centroid_index': {powiaty_codes[idx]: int(centroid) for idx, centroid in zip(centroid_idx[conn_pos], node[2 * m:2 * m + k])},
+    }
+    for column in edge_attributes:
+        conn_values = gdfConnections[column].to_numpy(dtype=float)[conn_pos] if column in gdfConnections else np.zeros(k)
+        arrays[column] = np.concatenate([gdfNet[column].to_numpy(dtype=float)[net_pos], conn_values])
+    arrays['node_index'] = {coords: i for i, coords in enumerate(arrays['nodes'])}
+
+    print(f"\tGraph nodes: {len(arrays['nodes'])}, edges: {len(arrays['u'])}.")
+
+    return arrays
+
+
+
+
+def arrays_to_nx_graph(arrays, weight='travel_time'):
+    """
+    Emits the NetworkX graph described by the edge arrays.
+
+    Network edges get the 'index' attribute and connections the 'connection_idx' attribute, as in
+    the original create_nx_graph. Of parallel edges the fastest one is kept, matching arrays_to_csr.
+    The arrays listed in arrays['edge_attributes'] become edge attributes as well, and the list is
+    kept in G.graph['edge_attributes'].
+    """
+
+    nodes = arrays['nodes']
+    u, v, w = arrays['u'], arrays['v'], arrays[weight]
+    edge_index = arrays.get('edge_index', np.full(len(u), -1))
+    connection_idx = arrays.get('connection_idx', np.full(len(u), -1))
+    attributes = tuple(arrays.get('edge_attributes', ()))
 
-    print("Creating nx graph")
-    # Step 1: Create a graph from the geometries
     G = nx.Graph()
+    G.add_nodes_from(nodes)
+    G.graph['centroid_index'] = {cid: nodes[i] for cid, i in arrays.get('centroid_index', {}).items()}
+    G.graph['edge_attributes'] = attributes
+    for cid, centroid_vertex in G.graph['centroid_index'].items():
+        G.nodes[centroid_vertex]['centroid_id'] = cid
+
+    def edge_data(e):
+        data = {weight: float(w[e])}
+        data.update((name, float(arrays[name][e])) for name in attributes)
+        if edge_index[e] >= 0:
+            data['index'] = int(edge_index[e])
+        if connection_idx[e] >= 0:
+            data['connection_idx'] = int(connection_idx[e])
+        return data
+
+    # Add the slowest edges first, so the fastest of parallel edges is the one that remains
+    G.add_edges_from((nodes[u[e]], nodes[v[e]], edge_data(e)) for e in np.argsort(-w, kind='stable'))
+
+    return G
 
-    # Add edges to the graph based on the gdfNet LineString geometries
-    for idx, geom in enumerate(gdfNet.geometry):
-        if isinstance(geom, LineString):
-            coords = list(geom.coords)
-            G.add_edge(coords[0], coords[-1], index=idx, travel_time = gdfNet.loc[idx, 'travel_time'])
 
-    # Check if the graph G is connected
-    is_connected = nx.is_connected(G)
 
-    # Print the result
-    if is_connected:
-        print("\nThe graph G is connected.")
-    else:
-        print("\nThe graph G is not connected.")
 
-    # Step 2: Add edges to the graph based on the gdfConnections LineString geometries
-    for idx, geom in enumerate(gdfConnections.geometry):
-        if isinstance(geom, LineString):
-            coords = list(geom.coords)
-            
-            # Add the centroid (starting point) as a vertex with a unique identifier
-            centroid_vertex = coords[0]
-            network_vertex = coords[-1]
+def create_nx_graph(gdfNet, gdfConnections, powiaty_codes, validate=False):
+    """
+    Creates the NetworkX graph of the network and the centroid connections.
 
-            # Add the centroid vertex with a 'centroid_id' attribute
-            G.add_node(centroid_vertex, centroid_id=powiaty_codes[idx])
+    The graph is emitted from the bulk edge arrays of create_graph_arrays. The centroid_id -> node
+    index is attached to the graph as G.graph['centroid_index'].
 
-            # Add the edge from the centroid to the network with 'travel_time' attribute
-            G.add_edge(centroid_vertex, network_vertex, connection_idx=idx, travel_time=gdfConnections.loc[idx, 'travel_time'])
+    Parameters:
+    - gdfNet: GeoDataFrame of the network segments with a 'travel_time' column.
+    - gdfConnections: GeoDataFrame of the centroid connections with a 'travel_time' column.
+    - powiaty_codes: List of centroid IDs (see create_graph_arrays).
+    - validate: If True, checks that the network and the whole graph are connected and that
+      all edges have the 'travel_time' attribute.
+    """
 
-    # Check if the graph G is connected
-    is_connected = nx.is_connected(G)
+    arrays = create_graph_arrays(gdfNet, gdfConnections, powiaty_codes)
 
-    # Print the result
-    if is_connected:
-        print("\nThe graph G is connected.")
-    else:
-        print("\nThe graph G is not connected.")
+    print("Creating nx graph")
+    G = arrays_to_nx_graph(arrays)
+
+    if validate:
+        # Check if the network alone and the graph with the connections are connected
+        network_nodes = {arrays['nodes'][i] for e in np.flatnonzero(arrays['edge_index'] >= 0) for i in (arrays['u'][e], arrays['v'][e])}
+        for name, graph in (("network", G.subgraph(network_nodes)), ("graph G", G)):
+            if nx.is_connected(graph):
+                print(f"\nThe {name} is connected.")
+            else:
+                print(f"\nThe {name} is not connected.")
+
+        # Check if all edges have "travel_time" attribute
+        if check_edges_have_attribute(G, "travel_time"):
+            print("\tAll edges have the 'travel_time' attribute.")
+        else:
+            print("\tNot all edges have the 'travel_time' attribute.")
 
     print(f"\nTotal number of graph edges: {len(G.edges())}")
 
-    # Check if all edges have "travel_time" attribute
-    if check_edges_have_attribute(G, "travel_time"):
-        print("\tAll edges have the 'travel_time' attribute.")
-    else:
-        print("\tNot all edges have the 'travel_time' attribute.")
-
     return G
 
 
 
 
 
+def contract_degree_two_chains(G, weight='travel_time', keep_nodes=()):
+    """
+    Contracts chains of degree-2 nodes of the graph into single edges.
+
+    Nodes that carry a routing decision are kept: junctions and dead ends (degree other than 2),
+    centroids and their access nodes on the network. Every chain of degree-2 nodes between two kept
+    nodes becomes one edge with the summed weight; of parallel chains only the fastest is kept.
+    Chains that close on themselves are dropped, as they never lie on a shortest path. The edge
+    attributes listed in G.graph['edge_attributes'] (e.g. 'length') are summed along the chains too.
+
+    Parameters:
+    - G: NetworkX graph as returned by create_nx_graph.
+    - weight: Name of the edge attribute that is summed along the chains.
+    - keep_nodes: Additional nodes that must not be contracted (e.g. where scenario lines attach).
+
+    Returns:
+    - H: Contracted NetworkX graph with the graph attributes of G (including the centroid index).
+      Every edge has the attribute 'segments' with the gdfNet indices of the segments it stands for;
+      contracted edges also have the removed nodes ('chain'), listed in order from 'chain_start'.
+    """
+
+    print("Contracting degree-2 chains")
+
+    centroids = {node for node, data in G.nodes(data=True) if 'centroid_id' in data}
+    access_nodes = {nbr for centroid in centroids for nbr in G[centroid]}
+    keep = {node for node in G if G.degree(node) != 2 or node in centroids or node in access_nodes or G.has_edge(node, node)}
+    keep.update(node for node in keep_nodes if node in G)
+
+    H = nx.Graph()
+    H.graph.update(G.graph)
+    H.add_nodes_from((node, G.nodes[node]) for node in keep)
+
+    attributes = G.graph.get('edge_attributes', ())
+
+    # First edges of the chains already walked from their other end
+    visited = set()
+    for start in keep:
+        for nbr, first_data in G[start].items():
+            if (start, nbr) in visited:
+                continue
+
+            # Walk along the chain until the next kept node
+            chain, segments, total = [], [], 0.0
+            sums = dict.fromkeys(attributes, 0.0)
+            prev, cur, data = start, nbr, first_data
+            while True:
+                total += data[weight]
+                for name in attributes:
+                    sums[name] += data.get(name, 0.0)
+                if 'index' in data:
+                    segments.append(data['index'])
+                if cur in keep:
+                    break
+                chain.append(cur)
+                nxt = next(node for node in G[cur] if node != prev)
+                prev, cur, data = cur, nxt, G[cur][nxt]
+            visited.add((cur, prev))
+
+            if cur == start:
+                continue
+            if H.has_edge(start, cur):
+                if H[start][cur][weight] <= total:
+                    continue
+                # Drop the slower edge with its attributes, so no stale chain or index is left behind
+                H.remove_edge(start, cur)
+
+            if chain:
+                H.add_edge(start, cur, **{**sums, weight: total}, segments=segments, chain=chain, chain_start=start)
+            else:
+                H.add_edge(start, cur, **first_data, segments=segments)
+
+    print(f"\tNodes before contraction: {G.number_of_nodes()}, after: {H.number_of_nodes()}.")
+    print(f"\tEdges before contraction: {G.number_of_edges()}, after: {H.number_of_edges()}.")
+
+    return H
+
+
+
+
+def expand_path(G, path):
+    """
+    Expands a path of the contracted graph into the nodes of the original graph.
+    """
+
+    full_path = [path[0]]
+    for u, v in zip(path[:-1], path[1:]):
+        chain = G[u][v].get('chain', [])
+        if chain and G[u][v]['chain_start'] != u:
+            chain = chain[::-1]
+        full_path.extend(chain)
+        full_path.append(v)
+    return full_path
+
+
+
+
+def path_segments(G, path):
+    """
+    Returns the gdfNet indices of the network segments along a path of the (contracted) graph.
+    """
+
+    segments = []
+    for u, v in zip(path[:-1], path[1:]):
+        data = G[u][v]
+        segments.extend(data['segments'] if 'segments' in data else [data['index']] if 'index' in data else [])
+    return segments
+
+
+
+
+def build_centroid_index(G):
+    """
+    Builds the centroid_id -> node index of the graph G by scanning its nodes once
+    and stores it in G.graph['centroid_index'].
+
+    create_nx_graph builds the index while adding the centroids, so this is only needed
+    for graphs constructed elsewhere.
+    """
+
+    G.graph['centroid_index'] = {data['centroid_id']: node for node, data in G.nodes(data=True) if 'centroid_id' in data}
+    return G.graph['centroid_index']
+
+
+
+
+def centroid_node(G, centroid_id):
+    """
+    Returns the node of the graph G corresponding to the centroid ID, using the centroid index.
+    """
+
+    centroid_index = G.graph.get('centroid_index')
+    if centroid_index is None:
+        centroid_index = build_centroid_index(G)
+
+    try:
+        return centroid_index[centroid_id]
+    except KeyError:
+        raise ValueError(f"The centroid ID {centroid_id} does not exist in the graph.") from None
+
+
+
+
 def shortest_path_between_centroids(G, centroid_id_1, centroid_id_2):
     """
     Computes the shortest path between two centroids in the graph G and the total travel time.
 
     Parameters:
-    - G: NetworkX graph where nodes corresponding to centroids have a 'centroid_id' attribute.
+    - G: NetworkX graph where nodes corresponding to centroids have a 'centroid_id' attribute
+      and G.graph['centroid_index'] maps centroid IDs to nodes.
     - centroid_id_1: ID of the starting centroid.
     - centroid_id_2: ID of the destination centroid.
 
@@ -283,17 +894,8 @@ def shortest_path_between_centroids(G, centroid_id_1, centroid_id_2):
     """
     
     # Find the nodes in the graph corresponding to the centroid IDs
-    start_node = None
-    end_node = None
-    
-    for node, data in G.nodes(data=True):
-        if data.get('centroid_id') == centroid_id_1:
-            start_node = node
-        elif data.get('centroid_id') == centroid_id_2:
-            end_node = node
-    
-    if start_node is None or end_node is None:
-        raise ValueError("One or both of the centroid IDs do not exist in the graph.")
+    start_node = centroid_node(G, centroid_id_1)
+    end_node = centroid_node(G, centroid_id_2)
     
     # Compute the shortest path between the two nodes
     path = nx.shortest_path(G, source=start_node, target=end_node, weight='travel_time')
@@ -309,7 +911,7 @@ def shortest_path_between_centroids(G, centroid_id_1, centroid_id_2):
 
 
 
-def plot_shortest_path(path, travel_time, gdfNet, file_name, ax=None):
+def plot_shortest_path(path, travel_time, gdfNet, file_name, ax=None, segments=None):
     """
     Plots the shortest path on the same plot as the gdfNet and adds the travel time to the legend.
     Optionally saves the plot to a file.
@@ -321,17 +923,22 @@ def plot_shortest_path(path, travel_time, gdfNet, file_name, ax=None):
     - gdfNet: GeoDataFrame of the railway network.
     - file_name: Optional file name to save the plot. If None, the plot is not saved.
     - ax: Matplotlib axis to plot on. If None, a new figure and axis will be created.
+    - segments: Optional gdfNet indices of the segments along the path (see path_segments),
+      drawn with their full geometry on top of the path line.
     """
+
+    import matplotlib.pyplot as plt
     
     # Create a LineString from the path nodes
     path_coords = [node for node in path]
-    path_line = LineString(path_coords)
+    path_line = shapely.LineString(path_coords)
     
     # Convert the LineString to a GeoDataFrame for easy plotting
     gdfPath = gpd.GeoDataFrame(geometry=[path_line], crs=gdfNet.crs)
     
     # Plot the railway network (gdfNet) if an axis is not provided
-    if ax is None:
+    own_figure = ax is None
+    if own_figure:
         fig, ax = plt.subplots(1, 1, figsize=(10, 10))
     else:
         fig = ax.figure
@@ -341,94 +948,1638 @@ def plot_shortest_path(path, travel_time, gdfNet, file_name, ax=None):
     
     # Plot the shortest path
     gdfPath.plot(ax=ax, color='red', linewidth=3, linestyle='--', label=f'Shortest Path (Travel Time: {travel_time:.2f} min)')
+
+    # Plot the full geometry of the network segments along the path
+    if segments is not None:
+        gdfNet.iloc[segments].plot(ax=ax, color='red', linewidth=1.5)
     
     # Add a legend
     ax.legend()
     
     # Save the plot to a file if file_name is provided
-    plt.savefig(file_name, format='png', bbox_inches='tight')
+    fig.savefig(file_name, format='png', bbox_inches='tight')
+    if own_figure:
+        plt.close(fig)
     print(f"\tPlot saved to {file_name}")
 
 
 
 
-def compute_travel_time_matrix(G, set_1, set_2):
+def graph_to_arrays(G, weight='travel_time', attributes=None):
     """
-    Computes a travel time matrix between two sets of points based on the shortest path in the graph G.
+    Converts the NetworkX graph into integer node ids and NumPy edge arrays.
 
     Parameters:
     - G: NetworkX graph where edges have a 'travel_time' attribute.
-    - set_1: List of centroid IDs corresponding to the first set of points.
-    - set_2: List of centroid IDs corresponding to the second set of points.
+    - weight: Name of the edge attribute used as the edge weight.
+    - attributes: Further numeric edge attributes to extract (0 where an edge lacks them).
+      If None, the ones listed in G.graph['edge_attributes'].
 
     Returns:
-    - travel_time_matrix: A 2D NumPy array where each element (i, j) is the travel time from set_1[i] to set_2[j].
+    - arrays: Dictionary with the graph nodes in the order of the integer ids ('nodes'),
+      the mapping from nodes to integer ids ('node_index'), the edge endpoints ('u', 'v'),
+      the edge weights (stored under the weight name), the attributes (stored under their names
+      and listed in 'edge_attributes'), the gdfNet indices of the segments every edge stands for
+      (as pairs of edge position 'segment_edge' and gdfNet index 'segment_index', see path_segments)
+      and the centroid_id -> node id index ('centroid_index').
     """
 
-    print("Computing travel time matrix")
-    
-    # Extract the nodes corresponding to centroid IDs in set_1 and set_2
-    nodes_set_1 = [next(node for node, data in G.nodes(data=True) if data.get('centroid_id') == cid) for cid in set_1]
-    nodes_set_2 = [next(node for node, data in G.nodes(data=True) if data.get('centroid_id') == cid) for cid in set_2]
-    
-    # Initialize the travel time matrix
-    travel_time_matrix = np.full((len(set_1), len(set_2)), np.inf)  # Fill with infinity as default
-    
-    # Compute shortest paths from all nodes in set_1 to all nodes in set_2
-    for i, node_start in enumerate(nodes_set_1):
-        print(f"\tBatch {i} out of {len(nodes_set_1)}.")
-        lengths = nx.single_source_dijkstra_path_length(G, source=node_start, weight='travel_time')
-        for j, node_end in enumerate(nodes_set_2):
-            travel_time_matrix[i, j] = lengths.get(node_end, np.inf)  # Default to infinity if no path exists
-    
-    return travel_time_matrix
+    nodes = list(G.nodes())
+    node_index = {node: i for i, node in enumerate(nodes)}
+    n_edges = G.number_of_edges()
 
+    edges = G.edges(data=weight)
+    u = np.fromiter((node_index[a] for a, b, w in edges), dtype=np.int64, count=n_edges)
+    v = np.fromiter((node_index[b] for a, b, w in edges), dtype=np.int64, count=n_edges)
+    w = np.fromiter((w for a, b, w in edges), dtype=np.float64, count=n_edges)
 
+    centroid_index = G.graph.get('centroid_index')
+    if centroid_index is None:
+        centroid_index = build_centroid_index(G)
+    centroid_index = {cid: node_index[node] for cid, node in centroid_index.items()}
 
+    attributes = tuple(G.graph.get('edge_attributes', ()) if attributes is None else attributes)
+    arrays = {'nodes': nodes, 'node_index': node_index, 'u': u, 'v': v, weight: w,
+              'edge_attributes': attributes, 'centroid_index': centroid_index}
+    for name in attributes:
+        arrays[name] = np.fromiter((value for a, b, value in G.edges(data=name, default=0.0)), dtype=np.float64, count=n_edges)
 
-def color_counties(shapefile_path, color_values, write_path):
-    """
-    Colors the counties in Poland according to the numbers passed in the list.
+    segment_edge, segment_index = [], []
+    for e, (a, b, data) in enumerate(G.edges(data=True)):
+        segments = data['segments'] if 'segments' in data else [data['index']] if 'index' in data else []
+        segment_edge.extend([e] * len(segments))
+        segment_index.extend(segments)
+    arrays['segment_edge'] = np.asarray(segment_edge, dtype=np.int64)
+    arrays['segment_index'] = np.asarray(segment_index, dtype=np.int64)
 
-    Parameters:
-    - shapefile_path: Path to the shapefile containing the administrative borders of counties.
-    - color_values: List of numbers used to color the counties. The order should match the order of the counties in the shapefile.
+    return arrays
+
+
+
+
+def centroid_node_ids(arrays, centroid_ids):
+    """
+    Returns the integer node ids of the centroids in the edge arrays.
     """
 
-    # Load the shapefile using GeoPandas
     try:
-        gdf = gpd.read_file(shapefile_path)
-    except FileNotFoundError:
-        print(f"File not found: {shapefile_path}")
+        return [arrays['centroid_index'][cid] for cid in centroid_ids]
+    except KeyError as e:
+        raise ValueError(f"The centroid ID {e.args[0]} does not exist in the graph.") from None
 
-    
-    # Ensure the color_values list is the same alength as the number of counties
-    if len(color_values) != len(gdf):
-        raise ValueError("The length of the color_values list must match the number of counties in the shapefile.")
-    
-    # Add the color values to the GeoDataFrame
-    gdf['color_value'] = color_values
 
-    cmap = plt.cm.viridis  # Use green colormap
-    
-    # Normalize the color values to a colormap range
-    norm = plt.Normalize(vmin=min(color_values), vmax=max(color_values))
-    
-    # Plot the counties with the assigned colors
-    fig, ax = plt.subplots(1, 1, figsize=(10, 10))
-    gdf.plot(column='color_value', cmap=cmap, linewidth=0.8, ax=ax, edgecolor='0.8')
-    
-    # Add a colorbar
-    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-    sm.set_array([])
-    fig.colorbar(sm, ax=ax)
-    
-    # Set title and show plot
-    plt.title("Poland: Counties (Powiaty) Colored by Distance from an Example Origin")
-    
-    # Save plot
-    plt.savefig(write_path, bbox_inches='tight')
-    print(f"\nPlot saved to {write_path}")
+
+
+def arrays_to_csr(arrays, weight='travel_time'):
+    """
+    Builds the sparse (CSR) adjacency matrix of the undirected graph described by the edge arrays.
+
+    Each edge is stored once, in the upper triangle. Self-loops are dropped and from parallel
+    edges only the one with the smallest weight is kept. Explicit zeros are kept, so zero-weight
+    edges remain edges.
+
+    Parameters:
+    - arrays: Dictionary of edge arrays as returned by graph_to_arrays.
+    - weight: Name of the edge attribute used as the edge weight.
+
+    Returns:
+    - csr: scipy.sparse.csr_matrix of shape (number of nodes, number of nodes).
+    """
+
+    lo, hi, edges = routing_edges(arrays, weight)
+    n_nodes = len(arrays['nodes'])
+    return csr_matrix((np.asarray(arrays[weight], dtype=np.float64)[edges], (lo, hi)), shape=(n_nodes, n_nodes))
+
+
+
+
+def routing_edges(arrays, weight='travel_time'):
+    """
+    Returns the edges stored by arrays_to_csr: one per node pair, the one with the smallest weight,
+    without self-loops, sorted by the node pair.
+
+    Returns:
+    - lo, hi: Smaller and larger integer node id of every edge.
+    - edges: Position of every edge in the edge arrays.
+    """
+
+    u, v, w = arrays['u'], arrays['v'], np.asarray(arrays[weight], dtype=np.float64)
+    lo, hi = np.minimum(u, v), np.maximum(u, v)
+    edges = np.flatnonzero(lo != hi)
+
+    # Sort by the node pair and then by the weight, so the first edge of each pair is the fastest
+    edges = edges[np.lexsort((w[edges], hi[edges], lo[edges]))]
+    lo, hi = lo[edges], hi[edges]
+    first = np.ones(len(lo), dtype=bool)
+    first[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+
+    return lo[first], hi[first], edges[first]
+
+
+
+
+def edge_segments(arrays):
+    """
+    Returns the gdfNet indices of the segments the edges stand for, as pairs of edge position
+    and gdfNet index (from graph_to_arrays, or from the 'edge_index' of create_graph_arrays).
+    """
+
+    if 'segment_edge' in arrays:
+        return arrays['segment_edge'], arrays['segment_index']
+    edge_index = np.asarray(arrays.get('edge_index', ()), dtype=np.int64)
+    edges = np.flatnonzero(edge_index >= 0)
+    return edges, edge_index[edges]
+
+
+
+
+# Read-only CSR matrix of the routing graph in a worker process of the parallel mode
+_worker_csr = None
+
+# Read-only extra arrays shared with the worker processes (see share_csr)
+_worker_arrays = {}
+
+
+def _init_dijkstra_worker(arrays_dir, shape, extra_names=()):
+    """
+    Initializes a worker process by memory-mapping the CSR arrays and the extra arrays written by share_csr.
+    """
+
+    global _worker_csr, _worker_arrays
+    data, indices, indptr = (np.load(os.path.join(arrays_dir, name + '.npy'), mmap_mode='r') for name in ('data', 'indices', 'indptr'))
+    _worker_csr = csr_matrix((data, indices, indptr), shape=shape, copy=False)
+    _worker_arrays = {name: np.load(os.path.join(arrays_dir, 'extra_' + name + '.npy'), mmap_mode='r') for name in extra_names}
+
+
+def _dijkstra_batch(sources, targets, limit=np.inf):
+    distances = dijkstra(_worker_csr, directed=False, indices=sources, limit=limit)
+    return distances[:, targets]
+
+
+
+
+def share_csr(csr, arrays_dir, extra=None):
+    """
+    Writes the CSR arrays (and the optional dictionary of extra arrays) to .npy files in arrays_dir,
+    so worker processes can memory-map them instead of receiving a pickled copy of the graph.
+    """
+
+    for name in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(arrays_dir, name + '.npy'), getattr(csr, name))
+    for name, values in (extra or {}).items():
+        np.save(os.path.join(arrays_dir, 'extra_' + name + '.npy'), values)
+
+
+
+
+def _default_batch_size(csr, n_sources, batch_size, n_workers):
+    if batch_size is not None:
+        return batch_size
+    batch_size = max(1, DIJKSTRA_BLOCK_SIZE // (max(csr.shape[0], 1) * n_workers))
+    if n_workers > 1:
+        batch_size = min(batch_size, max(1, -(-n_sources // (4 * n_workers))))
+    return batch_size
+
+
+
+
+@contextmanager
+def dijkstra_pool(csr, n_workers, extra=None):
+    """
+    Opens a process pool whose workers memory-map the CSR arrays (and the extra arrays) from a temporary directory.
+    """
+
+    with tempfile.TemporaryDirectory(prefix='travel_time_csr_') as arrays_dir:
+        share_csr(csr, arrays_dir, extra)
+        initargs = (arrays_dir, csr.shape, tuple(extra or ()))
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_dijkstra_worker, initargs=initargs) as executor:
+            yield executor
+
+
+
+
+def dijkstra_travel_times(csr, sources, targets, batch_size=None, n_workers=1, out=None, done=None, on_rows_done=None):
+    """
+    Computes the travel times from the source nodes to the target nodes with multi-source Dijkstra.
+
+    The sources are processed in batches; every batch is a single vectorized scipy call
+    and only the target columns of its result are kept. With n_workers > 1 the batches run
+    in a process pool whose workers memory-map the CSR arrays from a temporary directory.
+    The rows are always assembled in source order, so the result does not depend on n_workers.
+
+    Parameters:
+    - csr: Adjacency matrix of the undirected graph as returned by arrays_to_csr.
+    - sources: Integer ids of the source nodes.
+    - targets: Integer ids of the target nodes.
+    - batch_size: Number of sources per batch. If None, it is derived from DIJKSTRA_BLOCK_SIZE
+      (shared between the workers) and, in the parallel mode, capped so that every worker gets several batches.
+    - n_workers: Number of worker processes. 1 computes all batches in the current process.
+    - out: Optional preallocated array (e.g. a memory-mapped .npy, see open_matrix_store) the rows are written to.
+    - done: Optional boolean array of the rows already computed in out; batches whose rows are all done are skipped.
+    - on_rows_done: Optional callback on_rows_done(start, stop), called after the rows start:stop are written.
+
+    Returns:
+    - travel_time_matrix: A 2D NumPy array where each element (i, j) is the travel time from
+      sources[i] to targets[j] (np.inf if there is no path).
+    """
+
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    batch_size = _default_batch_size(csr, len(sources), batch_size, n_workers)
+
+    travel_time_matrix = np.full((len(sources), len(targets)), np.inf) if out is None else out
+    starts = range(0, len(sources), batch_size)
+    todo = [(b, start) for b, start in enumerate(starts) if done is None or not done[start:start + batch_size].all()]
+    batches = [sources[start:start + batch_size] for b, start in todo]
+
+    with (dijkstra_pool(csr, n_workers) if n_workers > 1 else nullcontext()) as executor:
+        if executor is None:
+            results = (dijkstra(csr, directed=False, indices=batch)[:, targets] for batch in batches)
+        else:
+            results = executor.map(_dijkstra_batch, batches, [targets] * len(batches))
+
+        progress = batch_progress(len(starts), sum(len(batch) for batch in batches))
+        for (b, start), block in zip(todo, results):
+            progress(b, len(block))
+            travel_time_matrix[start:start + len(block)] = block
+            if on_rows_done is not None:
+                on_rows_done(start, start + len(block))
+
+    return travel_time_matrix
+
+
+
+
+def dijkstra_travel_times_cutoff(csr, sources, targets, cutoff, batch_size=None, n_workers=1, dtype=np.float64):
+    """
+    Computes the travel times from the source nodes to the target nodes up to a cutoff.
+
+    Every search stops at the cutoff, and only the pairs within it are stored, as a sparse matrix.
+    Zero travel times (e.g. a centroid to itself) are kept as explicit entries, so a missing entry
+    always means "beyond the cutoff" (see sparse_to_dense).
+
+    Parameters:
+    - csr, sources, targets, batch_size, n_workers: As in dijkstra_travel_times.
+    - cutoff: Maximum travel time in minutes; pairs with a larger travel time are not stored.
+    - dtype: dtype of the stored travel times.
+
+    Returns:
+    - travel_time_matrix: scipy.sparse.csr_matrix of shape (len(sources), len(targets)).
+    """
+
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    batch_size = _default_batch_size(csr, len(sources), batch_size, n_workers)
+
+    starts = range(0, len(sources), batch_size)
+    batches = [sources[start:start + batch_size] for start in starts]
+    rows, cols, values = [], [], []
+
+    with (dijkstra_pool(csr, n_workers) if n_workers > 1 else nullcontext()) as executor:
+        if executor is None:
+            results = (dijkstra(csr, directed=False, indices=batch, limit=cutoff)[:, targets] for batch in batches)
+        else:
+            results = executor.map(_dijkstra_batch, batches, [targets] * len(batches), [cutoff] * len(batches))
+
+        progress = batch_progress(len(starts), len(sources))
+        for b, (start, block) in enumerate(zip(starts, results)):
+            progress(b, len(block))
+            r, c = np.nonzero(np.isfinite(block))
+            rows.append(r + start)
+            cols.append(c)
+            values.append(block[r, c].astype(dtype))
+
+    shape = (len(sources), len(targets))
+    if not rows:
+        return csr_matrix(shape, dtype=dtype)
+    return coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=shape).tocsr()
+
+
+
+
+def sparse_to_dense(travel_time_matrix, fill_value=np.inf):
+    """
+    Converts a cutoff-bounded sparse travel time matrix into a dense array,
+    filling the pairs beyond the cutoff with fill_value.
+    """
+
+    coo = travel_time_matrix.tocoo()
+    dense = np.full(coo.shape, fill_value, dtype=coo.dtype)
+    dense[coo.row, coo.col] = coo.data
+    return dense
+
+
+
+
+def accumulate_along_trees(predecessors, edge_keys, edge_values):
+    """
+    Sums edge values along the shortest path trees of a multi-source Dijkstra call.
+
+    The trees of all sources are walked at once by pointer jumping: every node first holds the value
+    of the edge to its predecessor, then repeatedly adds the sum held by its current ancestor and jumps
+    to that ancestor's ancestor, until all nodes point to their root. This takes a logarithmic
+    number of vectorized steps in the depth of the trees.
+
+    Parameters:
+    - predecessors: Array of shape (n_sources, n_nodes) as returned by dijkstra(..., return_predecessors=True).
+    - edge_keys: Sorted keys lo * n_nodes + hi of the routing edges (see routing_edges).
+    - edge_values: Array of shape (n_values, n_edges) with the values of the routing edges.
+
+    Returns:
+    - sums: Array of shape (n_values, n_sources, n_nodes) with the sums from every source to every node
+      (0 for the source itself and for unreachable nodes).
+    """
+
+    n_sources, n_nodes = predecessors.shape
+    pred = predecessors.ravel().astype(np.int64)
+    node = np.tile(np.arange(n_nodes, dtype=np.int64), n_sources)
+    has_pred = pred >= 0
+
+    sums = np.zeros((len(edge_values), n_sources * n_nodes))
+    keys = np.minimum(pred, node)[has_pred] * n_nodes + np.maximum(pred, node)[has_pred]
+    sums[:, has_pred] = edge_values[:, np.searchsorted(edge_keys, keys)]
+
+    # Roots and unreachable nodes point to themselves
+    parent = np.arange(n_sources * n_nodes, dtype=np.int64)
+    parent[has_pred] = (parent - node + pred)[has_pred]
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        sums += sums[:, parent]
+        parent = grandparent
+
+    return sums.reshape(len(edge_values), n_sources, n_nodes)
+
+
+
+
+def _route_trees(csr, sources, targets, edge_keys, edge_values, return_predecessors):
+    distances, predecessors = dijkstra(csr, directed=False, indices=sources, return_predecessors=True)
+    block = distances[:, targets]
+    block_sums = accumulate_along_trees(predecessors, edge_keys, edge_values)[:, :, targets]
+    block_sums[:, ~np.isfinite(block)] = np.inf
+    return block, block_sums, predecessors if return_predecessors else None
+
+
+def _route_batch(sources, targets, return_predecessors):
+    return _route_trees(_worker_csr, sources, targets, _worker_arrays['edge_keys'], _worker_arrays['edge_values'], return_predecessors)
+
+
+
+
+def dijkstra_routing(csr, sources, targets, edge_keys, edge_values, return_predecessors=False, batch_size=None, n_workers=1, out=None, done=None, on_rows_done=None):
+    """
+    Computes the travel times from the source nodes to the target nodes together with the sums of
+    further edge values along the same fastest paths, in a single multi-source Dijkstra pass.
+
+    Parameters:
+    - csr, sources, targets, n_workers: As in dijkstra_travel_times.
+    - edge_keys, edge_values: As in accumulate_along_trees.
+    - return_predecessors: If True, the shortest path trees are returned as well.
+    - batch_size: Number of sources per batch. If None, it is derived as in dijkstra_travel_times and
+      reduced for the additional arrays of the tree walk.
+    - out: Optional preallocated (travel_time_matrix, sums, predecessors) the rows are written to, e.g.
+      memory-mapped .npy files (see compute_routing_matrices); sums is a sequence of one array per value.
+    - done, on_rows_done: As in dijkstra_travel_times.
+
+    Returns:
+    - travel_time_matrix: Array of shape (len(sources), len(targets)), as in dijkstra_travel_times.
+    - sums: Array of shape (n_values, len(sources), len(targets)) with the summed edge values
+      (np.inf where there is no path).
+    - predecessors: int32 array of shape (len(sources), n_nodes) with the predecessor of every node
+      on the fastest path from each source (-9999 for the source and unreachable nodes), or None.
+    """
+
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    if batch_size is None:
+        batch_size = max(1, _default_batch_size(csr, len(sources), None, n_workers) // (len(edge_values) + 3))
+
+    if out is None:
+        travel_time_matrix = np.full((len(sources), len(targets)), np.inf)
+        sums = np.zeros((len(edge_values), len(sources), len(targets)))
+        predecessors = np.full((len(sources), csr.shape[0]), -9999, dtype=np.int32) if return_predecessors else None
+    else:
+        travel_time_matrix, sums, predecessors = out
+
+    starts = range(0, len(sources), batch_size)
+    todo = [(b, start) for b, start in enumerate(starts) if done is None or not done[start:start + batch_size].all()]
+    batches = [sources[start:start + batch_size] for b, start in todo]
+    extra = {'edge_keys': edge_keys, 'edge_values': edge_values}
+
+    with (dijkstra_pool(csr, n_workers, extra) if n_workers > 1 else nullcontext()) as executor:
+        if executor is None:
+            results = (_route_trees(csr, batch, targets, edge_keys, edge_values, return_predecessors) for batch in batches)
+        else:
+            results = executor.map(_route_batch, batches, [targets] * len(batches), [return_predecessors] * len(batches))
+
+        progress = batch_progress(len(starts), sum(len(batch) for batch in batches))
+        for (b, start), (block, block_sums, block_predecessors) in zip(todo, results):
+            progress(b, len(block))
+            stop = start + len(block)
+            travel_time_matrix[start:stop] = block
+            for values, block_values in zip(sums, block_sums):
+                values[start:stop] = block_values
+            if return_predecessors:
+                predecessors[start:stop] = block_predecessors
+            if on_rows_done is not None:
+                on_rows_done(start, stop)
+
+    return travel_time_matrix, sums, predecessors
+
+
+
+
+def condensed_index(n, i, j):
+    """
+    Returns the position of the pair (i, j), i != j, in the condensed upper-triangle form
+    of a symmetric n x n matrix (the layout of scipy.spatial.distance.squareform).
+    """
+
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+
+
+def condensed_size(condensed):
+    """
+    Returns the number of rows of the square matrix stored in the condensed form.
+    """
+
+    return int(round((1 + np.sqrt(1 + 8 * len(condensed))) / 2))
+
+
+
+
+def expand_condensed_matrix(condensed):
+    """
+    Expands a condensed upper-triangle travel time matrix into the square form (zero diagonal).
+    """
+
+    return squareform(condensed, checks=False)
+
+
+
+
+def periphery_first_order(coords):
+    """
+    Orders points by decreasing distance from their mean.
+
+    Used by the symmetric mode: when the sources are processed in this order, the targets still
+    missing for a row are the points closer to the centre, so the limits of its searches shrink
+    as the computation progresses.
+    """
+
+    coords = np.asarray(coords, dtype=float)
+    return np.argsort(-np.linalg.norm(coords - coords.mean(axis=0), axis=1), kind='stable')
+
+
+
+
+def _symmetric_limit(condensed, order, start, stop):
+    """
+    Upper bound on the travel times from the rows order[start:stop] to the rows after them,
+    derived with the triangle inequality from the rows order[:start] that are already computed.
+    For every source the SYMMETRIC_LANDMARKS computed rows closest to it give the tightest bounds.
+    """
+
+    if start == 0:
+        return np.inf
+
+    n = len(order)
+    done = order[:start]
+
+    bound = 0.0
+    for r in range(start, stop):
+        ahead = order[r + 1:]
+        if len(ahead) == 0:
+            continue
+        d_done = condensed[condensed_index(n, done, order[r])].astype(np.float64)
+        closest = np.argsort(d_done, kind='stable')[:SYMMETRIC_LANDMARKS]
+        d_ahead = condensed[condensed_index(n, done[closest][:, None], ahead[None, :])].astype(np.float64)
+        bound = max(bound, (d_done[closest][:, None] + d_ahead).min(axis=0).max())
+        if np.isinf(bound):
+            return np.inf
+
+    return bound * (1 + LIMIT_SLACK)
+
+
+
+
+def dijkstra_travel_times_symmetric(csr, nodes, order=None, batch_size=None, n_workers=1, dtype=np.float64, out=None, done=None, on_rows_done=None):
+    """
+    Computes the symmetric travel time matrix between the nodes, each unordered pair once,
+    and returns it in condensed upper-triangle form.
+
+    The rows are processed in the given order and row r only searches for the nodes that come
+    after it. Before a batch is routed, the rows already computed bound its remaining travel times
+    through the triangle inequality, and the searches stop at that limit instead of settling the
+    whole network. In the parallel mode the batches run in waves of n_workers, each bounded by the
+    rows of the previous waves, so the result does not depend on n_workers.
+
+    Parameters:
+    - csr: Adjacency matrix of the undirected graph as returned by arrays_to_csr.
+    - nodes: Integer ids of the nodes (rows and columns of the matrix).
+    - order: Order in which the rows are processed (e.g. periphery_first_order of the centroids). Defaults to the given order.
+    - batch_size: Number of sources per batch, as in dijkstra_travel_times.
+    - n_workers: Number of worker processes.
+    - dtype: dtype of the stored travel times (np.float32 halves the memory again).
+    - out, done, on_rows_done: As in dijkstra_travel_times; out is the condensed array and the rows
+      are counted in the processing order.
+
+    Returns:
+    - condensed: 1D array of length n * (n - 1) / 2 with the travel times of the pairs (i, j), i < j,
+      in the layout of scipy.spatial.distance.squareform (see expand_condensed_matrix).
+    """
+
+    nodes = np.asarray(nodes, dtype=np.int64)
+    n = len(nodes)
+    order = np.arange(n) if order is None else np.asarray(order, dtype=np.int64)
+    batch_size = _default_batch_size(csr, n, batch_size, n_workers)
+
+    condensed = np.full(n * (n - 1) // 2, np.inf, dtype=dtype) if out is None else out
+    starts = list(range(0, n, batch_size))
+    todo = [(b, start) for b, start in enumerate(starts) if done is None or not done[start:start + batch_size].all()]
+    wave_size = max(n_workers, 1)
+
+    progress = batch_progress(len(starts), sum(min(start + batch_size, n) - start for b, start in todo))
+    with (dijkstra_pool(csr, n_workers) if n_workers > 1 else nullcontext()) as executor:
+        for w in range(0, len(todo), wave_size):
+            numbers, wave = zip(*todo[w:w + wave_size])
+            stops = [min(start + batch_size, n) for start in wave]
+            batches = [nodes[order[start:stop]] for start, stop in zip(wave, stops)]
+            targets = [nodes[order[start + 1:]] for start in wave]
+            limits = [_symmetric_limit(condensed, order, start, stop) for start, stop in zip(wave, stops)]
+
+            if executor is None:
+                results = (dijkstra(csr, directed=False, indices=batch, limit=limit)[:, target] for batch, target, limit in zip(batches, targets, limits))
+            else:
+                results = executor.map(_dijkstra_batch, batches, targets, limits)
+
+            for b, start, stop, block in zip(numbers, wave, stops, results):
+                progress(b, stop - start)
+                for r in range(start, stop):
+                    condensed[condensed_index(n, order[r], order[r + 1:])] = block[r - start, r - start:]
+                if on_rows_done is not None:
+                    on_rows_done(start, stop)
+
+    return condensed
+
+
+
+
+def _done_ranges(done):
+    """
+    Compresses a boolean array of done rows into a list of [start, stop) ranges.
+    """
+
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], done.astype(np.int8), [0]])))
+    return edges.reshape(-1, 2).tolist()
+
+
+
+
+def graph_digest(csr, sources=(), targets=()):
+    """
+    Returns the SHA-256 digest of the CSR arrays (structure and travel times) and of the source and
+    target node ids, identifying the routing problem in the manifests of the matrix and tile stores.
+    """
+
+    digest = hashlib.sha256(json.dumps(list(csr.shape)).encode())
+    for array in (csr.data, csr.indices, csr.indptr, np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64)):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+
+
+def open_matrix_store(out_path, shape, dtype, key, fill_value=np.inf):
+    """
+    Opens the memory-mapped .npy file a travel time matrix is streamed to, with its progress manifest.
+
+    The manifest (out_path + '.progress.json') records the shape, the dtype, a key identifying the
+    computation and the ranges of rows already written. If both files exist and the manifest matches,
+    the computation resumes from them; otherwise a new matrix filled with fill_value is created.
+
+    Parameters:
+    - out_path: Path of the matrix without the extension.
+    - shape: Shape of the stored matrix (1D for the condensed form).
+    - dtype: dtype of the stored travel times.
+    - key: JSON-serializable identification of the computation (the centroid IDs, the mode and the
+      graph_digest of the graph), so a changed network or speed never resumes from stale rows.
+
+    Returns:
+    - matrix: numpy.memmap of the stored matrix.
+    - done: Boolean array of the rows already written.
+    - on_rows_done: Callback that flushes the matrix and records the rows start:stop in the manifest.
+    """
+
+    npy_path = out_path + '.npy'
+    manifest_path = out_path + '.progress.json'
+    n_rows = shape[0] if len(shape) == 2 else condensed_size(np.empty(shape[0]))
+    meta = {'shape': list(shape), 'dtype': np.dtype(dtype).str, 'key': hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest()}
+
+    done = np.zeros(n_rows, dtype=bool)
+    manifest = None
+    if os.path.exists(npy_path) and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    if manifest is not None and all(manifest.get(name) == value for name, value in meta.items()):
+        matrix = np.lib.format.open_memmap(npy_path, mode='r+')
+        for start, stop in manifest['rows_done']:
+            done[start:stop] = True
+        print(f"\tResuming from {npy_path}: {done.sum()} out of {n_rows} rows done.")
+    else:
+        matrix = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=tuple(shape))
+        matrix[...] = fill_value
+
+    def on_rows_done(start, stop):
+        done[start:stop] = True
+        matrix.flush()
+        manifest_tmp = manifest_path + '.tmp'
+        with open(manifest_tmp, 'w') as f:
+            json.dump(dict(meta, rows_done=_done_ranges(done)), f)
+        os.replace(manifest_tmp, manifest_path)
+
+    on_rows_done(0, 0)
+
+    return matrix, done, on_rows_done
+
+
+
+
+def export_matrix_csv(npy_path, csv_path):
+    """
+    Exports a travel time matrix stored as .npy (square or condensed) to CSV.
+    """
+
+    print(f"Exporting {npy_path} to csv")
+    travel_time_matrix = np.load(npy_path, mmap_mode='r')
+    if travel_time_matrix.ndim == 1:
+        travel_time_matrix = expand_condensed_matrix(travel_time_matrix)
+    np.savetxt(csv_path, travel_time_matrix, delimiter=',')
+
+
+
+
+def compute_travel_time_matrix(G, set_1, set_2, backend='csgraph', n_workers=1, symmetric=False, condensed=False, dtype=np.float64, out_path=None, cutoff=None):
+    """
+    Computes a travel time matrix between two sets of points based on the shortest path in the graph G.
+
+    Parameters:
+    - G: NetworkX graph where edges have a 'travel_time' attribute, or its edge arrays
+      (create_graph_arrays, graph_to_arrays).
+    - set_1: List of centroid IDs corresponding to the first set of points.
+    - set_2: List of centroid IDs corresponding to the second set of points.
+    - backend: 'csgraph' converts the graph once into CSR arrays and runs batched multi-source
+      Dijkstra from scipy; 'networkx' runs one nx.single_source_dijkstra_path_length per source
+      and is kept as the reference implementation.
+    - n_workers: Number of worker processes used by the 'csgraph' backend (see dijkstra_travel_times).
+    - symmetric: If True, set_1 and set_2 must be the same list and every unordered pair is computed
+      only once (see dijkstra_travel_times_symmetric). Requires the 'csgraph' backend.
+    - condensed: If True (only with symmetric), the matrix is returned in condensed upper-triangle
+      form instead of being expanded to the square array (see expand_condensed_matrix).
+    - dtype: dtype of the returned travel times.
+    - out_path: If set, the rows are streamed to the memory-mapped file out_path + '.npy' as each batch
+      finishes, with a progress manifest, and an interrupted run resumes from the first missing rows
+      (see open_matrix_store). The file holds the condensed form in the symmetric mode.
+    - cutoff: If set, every search stops at this travel time in minutes and the result is a sparse
+      matrix holding only the pairs within the cutoff (see dijkstra_travel_times_cutoff and sparse_to_dense).
+
+    Returns:
+    - travel_time_matrix: A 2D NumPy array where each element (i, j) is the travel time from set_1[i] to set_2[j],
+      its condensed 1D form, or a scipy.sparse.csr_matrix with a cutoff.
+    """
+
+    if backend not in ('csgraph', 'networkx'):
+        raise ValueError("Invalid backend. Choose 'csgraph' or 'networkx'.")
+    if symmetric and (backend != 'csgraph' or list(set_1) != list(set_2)):
+        raise ValueError("The symmetric mode requires the 'csgraph' backend and set_1 equal to set_2.")
+    if condensed and not symmetric:
+        raise ValueError("The condensed form is only available in the symmetric mode.")
+    if cutoff is not None and (symmetric or out_path is not None):
+        raise ValueError("The cutoff cannot be combined with the symmetric mode or out_path.")
+
+    print("Computing travel time matrix")
+
+    if backend == 'csgraph' or out_path is not None:
+        arrays = G if isinstance(G, dict) else graph_to_arrays(G)
+        csr = arrays_to_csr(arrays)
+        sources = centroid_node_ids(arrays, set_1)
+        targets = centroid_node_ids(arrays, set_2)
+
+    store = {}
+    if out_path is not None:
+        shape = (len(set_1) * (len(set_1) - 1) // 2,) if symmetric else (len(set_1), len(set_2))
+        key = {'set_1': list(set_1), 'set_2': list(set_2), 'symmetric': symmetric, 'graph': graph_digest(csr, sources, targets)}
+        store['out'], store['done'], store['on_rows_done'] = open_matrix_store(out_path, shape, dtype, key)
+
+    if backend == 'csgraph':
+        if cutoff is not None:
+            return dijkstra_travel_times_cutoff(csr, sources, targets, cutoff, n_workers=n_workers, dtype=dtype)
+        if not symmetric:
+            return dijkstra_travel_times(csr, sources, targets, n_workers=n_workers, **store).astype(dtype, copy=False)
+
+        # Process the centroids from the periphery inwards, using their coordinates (the node keys)
+        try:
+            order = periphery_first_order([arrays['nodes'][i] for i in sources])
+        except (TypeError, ValueError):
+            order = None
+        travel_time_matrix = dijkstra_travel_times_symmetric(csr, sources, order=order, n_workers=n_workers, dtype=dtype, **store)
+        return travel_time_matrix if condensed else expand_condensed_matrix(travel_time_matrix)
+
+    if isinstance(G, dict):
+        G = arrays_to_nx_graph(G)
+
+    # Extract the nodes corresponding to centroid IDs in set_1 and set_2
+    nodes_set_1 = [centroid_node(G, cid) for cid in set_1]
+    nodes_set_2 = [centroid_node(G, cid) for cid in set_2]
+    
+    if cutoff is not None:
+        rows, cols, values = [], [], []
+        for i, node_start in enumerate(nodes_set_1):
+            print(f"\tBatch {i} out of {len(nodes_set_1)}.")
+            lengths = nx.single_source_dijkstra_path_length(G, source=node_start, cutoff=cutoff, weight='travel_time')
+            for j, node_end in enumerate(nodes_set_2):
+                if node_end in lengths:
+                    rows.append(i)
+                    cols.append(j)
+                    values.append(lengths[node_end])
+        return coo_matrix((np.asarray(values, dtype=dtype), (rows, cols)), shape=(len(set_1), len(set_2))).tocsr()
+
+    # Initialize the travel time matrix
+    travel_time_matrix = store.get('out', np.full((len(set_1), len(set_2)), np.inf))  # Fill with infinity as default
+    
+    # Compute shortest paths from all nodes in set_1 to all nodes in set_2
+    for i, node_start in enumerate(nodes_set_1):
+        if 'done' in store and store['done'][i]:
+            continue
+        print(f"\tBatch {i} out of {len(nodes_set_1)}.")
+        lengths = nx.single_source_dijkstra_path_length(G, source=node_start, weight='travel_time')
+        for j, node_end in enumerate(nodes_set_2):
+            travel_time_matrix[i, j] = lengths.get(node_end, np.inf)  # Default to infinity if no path exists
+        if 'on_rows_done' in store:
+            store['on_rows_done'](i, i + 1)
+    
+    return travel_time_matrix.astype(dtype, copy=False)
+
+
+
+
+def tile_path(out_dir, origin_block, destination_block):
+    return os.path.join(out_dir, f"tile-{origin_block:05d}-{destination_block:05d}.npy")
+
+
+
+
+def open_tile_store(out_dir, set_1, set_2, origin_block, destination_block, dtype, graph):
+    """
+    Opens the directory a tiled travel time matrix is streamed to, with its progress manifest.
+
+    The store holds one .npy file per tile of origin_block origins x destination_block destinations
+    (see tile_path), the zone IDs of both axes (zones.json) and the manifest (manifest.json) with the
+    shape, the dtype, the block sizes, a key of the zone IDs and of the graph (graph, see graph_digest)
+    and the ranges of origin blocks already written. If the manifest matches, the computation resumes
+    from it; otherwise, e.g. after the network or the speeds changed, the old tiles are removed.
+
+    Returns:
+    - manifest: Dictionary of the manifest entries.
+    - done: Boolean array of the origin blocks already written.
+    - on_block_done: Callback that records the origin block b in the manifest.
+    """
+
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    zones = {name: [zone.item() if isinstance(zone, np.generic) else zone for zone in ids] for name, ids in [('set_1', set_1), ('set_2', set_2)]}
+    meta = {'shape': [len(set_1), len(set_2)], 'dtype': np.dtype(dtype).str, 'origin_block': int(origin_block),
+            'destination_block': int(destination_block), 'key': hashlib.sha256(json.dumps(dict(zones, graph=graph), default=str).encode()).hexdigest()}
+
+    done = np.zeros(-(-len(set_1) // origin_block), dtype=bool)
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    if manifest is not None and all(manifest.get(name) == value for name, value in meta.items()):
+        for start, stop in manifest['blocks_done']:
+            done[start:stop] = True
+        print(f"\tResuming from {out_dir}: {done.sum()} out of {len(done)} origin blocks done.")
+    else:
+        _makedirs(out_dir)
+        for name in os.listdir(out_dir):
+            if name.startswith('tile-') and name.endswith('.npy'):
+                os.remove(os.path.join(out_dir, name))
+        with open(os.path.join(out_dir, 'zones.json'), 'w') as f:
+            json.dump(zones, f, default=str)
+
+    def on_block_done(b):
+        done[b] = True
+        manifest_tmp = manifest_path + '.tmp'
+        with open(manifest_tmp, 'w') as f:
+            json.dump(dict(meta, blocks_done=_done_ranges(done)), f)
+        os.replace(manifest_tmp, manifest_path)
+
+    on_block_done(slice(0, 0))
+
+    return dict(meta, blocks_done=_done_ranges(done)), done, on_block_done
+
+
+
+
+def compute_travel_time_tiles(G, set_1, set_2, out_dir, origin_block=None, destination_block=4096, n_workers=1, dtype=np.float32):
+    """
+    Computes the travel time matrix between two large sets of zones out-of-core, as tiles of origin
+    blocks x destination blocks in an on-disk store.
+
+    Every origin block is one multi-source Dijkstra call (in a worker process with n_workers > 1);
+    its rows are split into destination tiles and saved as soon as it finishes, so the memory use is
+    bounded by the blocks in flight and not by the size of the matrix, and an interrupted run resumes
+    from the first missing block (see open_tile_store).
+
+    Parameters:
+    - G: NetworkX graph where edges have a 'travel_time' attribute, or its edge arrays, with the zones
+      as centroids (see upload_zones and prepare_centroids_for_conversion_into_graph).
+    - set_1: List of zone IDs of the origins.
+    - set_2: List of zone IDs of the destinations.
+    - out_dir: Directory of the tile store.
+    - origin_block: Number of origins per block. If None, it is derived from DIJKSTRA_BLOCK_SIZE
+      (see dijkstra_travel_times).
+    - destination_block: Number of destinations per tile.
+    - n_workers: Number of worker processes.
+    - dtype: dtype of the stored travel times.
+
+    Returns:
+    - manifest: Dictionary of the manifest entries of the finished store.
+    """
+
+    print("Computing travel time tiles")
+
+    arrays = G if isinstance(G, dict) else graph_to_arrays(G)
+    csr = arrays_to_csr(arrays)
+    sources = np.asarray(centroid_node_ids(arrays, set_1), dtype=np.int64)
+    targets = np.asarray(centroid_node_ids(arrays, set_2), dtype=np.int64)
+    origin_block = _default_batch_size(csr, len(sources), origin_block, n_workers)
+
+    manifest, done, on_block_done = open_tile_store(out_dir, set_1, set_2, origin_block, destination_block, dtype,
+                                                    graph_digest(csr, sources, targets))
+    starts = range(0, len(sources), origin_block)
+    todo = [(b, start) for b, start in enumerate(starts) if not done[b]]
+    batches = [sources[start:start + origin_block] for b, start in todo]
+    print(f"\t{len(todo)} origin blocks of {origin_block} zones, {-(-len(targets) // destination_block)} tiles each.")
+
+    with (dijkstra_pool(csr, n_workers) if n_workers > 1 else nullcontext()) as executor:
+        if executor is None:
+            results = (dijkstra(csr, directed=False, indices=batch)[:, targets] for batch in batches)
+        else:
+            results = executor.map(_dijkstra_batch, batches, [targets] * len(batches))
+
+        progress = batch_progress(len(starts), sum(len(batch) for batch in batches))
+        for (b, start), block in zip(todo, results):
+            for t, column in enumerate(range(0, len(targets), destination_block)):
+                np.save(tile_path(out_dir, b, t), block[:, column:column + destination_block].astype(dtype))
+            on_block_done(b)
+            progress(b, len(block))
+
+    return dict(manifest, blocks_done=_done_ranges(done))
+
+
+
+
+def read_tile_manifest(out_dir):
+    """
+    Returns the manifest of a tile store together with its zone IDs ('set_1', 'set_2').
+    """
+
+    with open(os.path.join(out_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    with open(os.path.join(out_dir, 'zones.json')) as f:
+        manifest.update(json.load(f))
+    return manifest
+
+
+
+
+def iter_tiles(out_dir, mmap_mode='r'):
+    """
+    Yields the tiles of the finished origin blocks of a tile store as (rows, columns, tile), where
+    rows and columns are the slices of set_1 and set_2 the tile covers.
+    """
+
+    manifest = read_tile_manifest(out_dir)
+    n_rows, n_columns = manifest['shape']
+    origin_block, destination_block = manifest['origin_block'], manifest['destination_block']
+    for start, stop in manifest['blocks_done']:
+        for b in range(start, stop):
+            rows = slice(b * origin_block, min((b + 1) * origin_block, n_rows))
+            for t, column in enumerate(range(0, n_columns, destination_block)):
+                columns = slice(column, min(column + destination_block, n_columns))
+                yield rows, columns, np.load(tile_path(out_dir, b, t), mmap_mode=mmap_mode)
+
+
+
+
+def zones_to_regions(gdfZones, gdfRegions, region_column):
+    """
+    Assigns every zone to the region (e.g. the powiat) its point lies in, or to the nearest region
+    for points outside all of them.
+
+    Returns:
+    - regions: Array of the region IDs of the zones, in the order of gdfZones.
+    """
+
+    gdfRegions = gdfRegions[[region_column, 'geometry']].to_crs(gdfZones.crs)
+    points = gdfZones[['geometry']].reset_index(drop=True)
+    joined = gpd.sjoin(points, gdfRegions, how='left', predicate='within')
+    regions = joined[~joined.index.duplicated()][region_column].copy()
+
+    outside = regions.isna().to_numpy()
+    if outside.any():
+        nearest = gpd.sjoin_nearest(points[outside], gdfRegions, how='left')
+        regions[outside] = nearest[~nearest.index.duplicated()][region_column]
+        print(f"\tZones outside all regions assigned to the nearest one: {outside.sum()}.")
+    return regions.to_numpy()
+
+
+
+
+def aggregate_tiles(out_dir, origin_regions, destination_regions=None, origin_weights=None, destination_weights=None, regions=None):
+    """
+    Aggregates a tiled zone matrix to regions (e.g. powiaty) as the weighted mean travel time over
+    the connected zone pairs of every pair of regions, reading one tile at a time.
+
+    The weights are typically the population of the zones, so the result is the mean travel time of
+    a resident of the origin region to a resident of the destination region. The diagonal holds the
+    mean travel time within each region.
+
+    Parameters:
+    - out_dir: Directory of a finished tile store (see compute_travel_time_tiles).
+    - origin_regions: Region ID of every origin zone, in the order of set_1 of the store.
+    - destination_regions: Region ID of every destination zone (default: origin_regions).
+    - origin_weights: Weight of every origin zone (equal weights if None).
+    - destination_weights: Weight of every destination zone (default: origin_weights).
+    - regions: Region IDs in the order of the rows and columns of the result (default: sorted IDs).
+
+    Returns:
+    - travel_time_matrix: A 2D NumPy array of the weighted mean travel times between the regions
+      (np.inf where no zone pair is connected).
+    - regions: List of the region IDs of the rows and columns.
+    """
+
+    print("Aggregating travel time tiles")
+
+    manifest = read_tile_manifest(out_dir)
+    n_rows, n_columns = manifest['shape']
+    if _done_ranges(np.ones(-(-n_rows // manifest['origin_block']), dtype=bool)) != manifest['blocks_done']:
+        raise ValueError(f"The tile store {out_dir} is not complete.")
+
+    origin_regions = np.asarray(origin_regions)
+    destination_regions = origin_regions if destination_regions is None else np.asarray(destination_regions)
+    origin_weights = np.ones(n_rows) if origin_weights is None else np.asarray(origin_weights, dtype=np.float64)
+    destination_weights = origin_weights if destination_weights is None else np.asarray(destination_weights, dtype=np.float64)
+    if len(origin_regions) != n_rows or len(destination_regions) != n_columns or len(destination_weights) != n_columns:
+        raise ValueError("The regions and weights must match the zones of the tile store.")
+
+    regions = np.unique(np.concatenate([origin_regions, destination_regions])).tolist() if regions is None else list(regions)
+    index = {region: k for k, region in enumerate(regions)}
+    try:
+        origin_index = np.array([index[region] for region in origin_regions], dtype=np.int64)
+        destination_index = np.array([index[region] for region in destination_regions], dtype=np.int64)
+    except KeyError as e:
+        raise ValueError(f"The region {e.args[0]} is not in regions.") from None
+
+    # Sparse region x zone matrices holding the zone weights, so every tile is reduced by two products
+    origin_matrix = csr_matrix((origin_weights, (origin_index, np.arange(n_rows))), shape=(len(regions), n_rows))
+    destination_matrix = csr_matrix((destination_weights, (destination_index, np.arange(n_columns))), shape=(len(regions), n_columns))
+
+    total = np.zeros((len(regions), len(regions)))
+    weight = np.zeros((len(regions), len(regions)))
+    for rows, columns, tile in iter_tiles(out_dir):
+        finite = np.isfinite(tile)
+        left, right = origin_matrix[:, rows], destination_matrix[:, columns].T
+        total += np.asarray((left @ np.where(finite, tile, 0.0)) @ right)
+        weight += np.asarray((left @ finite.astype(np.float64)) @ right)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        travel_time_matrix = np.where(weight > 0, total / weight, np.inf)
+    return travel_time_matrix, regions
+
+
+
+
+def compute_routing_matrices(G, set_1, set_2, attributes=None, return_predecessors=False, n_workers=1, dtype=np.float64, out_path=None):
+    """
+    Computes the travel time matrix between two sets of points together with matrices of further
+    edge attributes summed along the same fastest paths, in a single routing pass.
+
+    Every attribute is accumulated along the path that minimizes the travel time, so e.g. the
+    'length' matrix holds the km of the fastest connection, not of the shortest one. With
+    return_predecessors the shortest path trees are kept as compact int32 arrays, from which any
+    path from set_1 is rebuilt without a new search (see routing_path).
+
+    Parameters:
+    - G: NetworkX graph where edges have a 'travel_time' attribute, or its edge arrays
+      (create_graph_arrays, graph_to_arrays).
+    - set_1: List of centroid IDs of the origins.
+    - set_2: List of centroid IDs of the destinations.
+    - attributes: Names of the edge attributes to accumulate, e.g. 'length' (km) or the km on new lines
+      given to create_graph_arrays as an edge attribute. If None, all listed in 'edge_attributes'.
+    - return_predecessors: If True, the predecessor arrays of the sources are kept in the result.
+    - n_workers: Number of worker processes (see dijkstra_routing).
+    - dtype: dtype of the returned matrices.
+    - out_path: If set, the rows are streamed as each batch finishes to memory-mapped files with
+      progress manifests (see open_matrix_store): the travel times to out_path + '.npy', every attribute
+      to out_path + '-<name>.npy' and the predecessors to out_path + '-predecessors.npy'. An interrupted
+      run resumes from the first missing rows; a changed graph starts anew.
+
+    Returns:
+    - routing: Dictionary with the travel time matrix ('travel_time'), one matrix per attribute
+      (stored under its name), the centroid IDs ('set_1', 'set_2') and their integer node ids
+      ('sources', 'targets'), the graph nodes in the order of the integer ids ('nodes'), the
+      predecessor arrays ('predecessors', None unless return_predecessors), the sorted keys of the
+      routing edges ('edge_keys', see accumulate_along_trees) and the gdfNet indices of the segments
+      they stand for (pairs of routing edge 'segment_edge' and gdfNet index 'segment_index').
+    """
+
+    print("Computing routing matrices")
+
+    arrays = G if isinstance(G, dict) else graph_to_arrays(G, attributes=attributes)
+    attributes = tuple(arrays.get('edge_attributes', ()) if attributes is None else attributes)
+    missing = [name for name in attributes if name not in arrays]
+    if missing:
+        raise ValueError(f"The edge attributes {missing} do not exist in the graph.")
+
+    lo, hi, edges = routing_edges(arrays)
+    n_nodes = len(arrays['nodes'])
+    csr = csr_matrix((np.asarray(arrays['travel_time'], dtype=np.float64)[edges], (lo, hi)), shape=(n_nodes, n_nodes))
+    edge_values = np.array([np.asarray(arrays[name], dtype=np.float64)[edges] for name in attributes]).reshape(len(attributes), len(edges))
+
+    sources = centroid_node_ids(arrays, set_1)
+    targets = centroid_node_ids(arrays, set_2)
+    edge_keys = lo * n_nodes + hi
+
+    store = {}
+    if out_path is not None:
+        shape = (len(sources), len(targets))
+        key = {'set_1': list(set_1), 'set_2': list(set_2), 'attributes': list(attributes), 'return_predecessors': return_predecessors,
+               'graph': graph_digest(csr, sources, targets)}
+        matrices = [open_matrix_store(out_path, shape, dtype, key)]
+        matrices += [open_matrix_store(f"{out_path}-{name}", shape, dtype, key) for name in attributes]
+        if return_predecessors:
+            matrices.append(open_matrix_store(out_path + '-predecessors', (len(sources), n_nodes), np.int32, key, fill_value=-9999))
+
+        def on_rows_done(start, stop):
+            for matrix, done, on_matrix_rows_done in matrices:
+                on_matrix_rows_done(start, stop)
+
+        store['out'] = (matrices[0][0], [matrix for matrix, done, on_matrix_rows_done in matrices[1:1 + len(attributes)]],
+                        matrices[-1][0] if return_predecessors else None)
+        store['done'] = np.logical_and.reduce([done for matrix, done, on_matrix_rows_done in matrices])
+        store['on_rows_done'] = on_rows_done
+
+    travel_time_matrix, sums, predecessors = dijkstra_routing(csr, sources, targets, edge_keys, edge_values,
+                                                              return_predecessors=return_predecessors, n_workers=n_workers, **store)
+
+    # Segments of the edges dropped from parallel edges are never on a fastest path
+    routing_edge = np.full(len(arrays['u']), -1, dtype=np.int64)
+    routing_edge[edges] = np.arange(len(edges))
+    segment_edge, segment_index = edge_segments(arrays)
+    segment_edge = routing_edge[segment_edge]
+    on_routing = segment_edge >= 0
+
+    routing = {
+        'travel_time': travel_time_matrix.astype(dtype, copy=False),
+        'set_1': list(set_1),
+        'set_2': list(set_2),
+        'sources': np.asarray(sources, dtype=np.int64),
+        'targets': np.asarray(targets, dtype=np.int64),
+        'nodes': arrays['nodes'],
+        'predecessors': predecessors,
+        'edge_keys': edge_keys,
+        'segment_edge': segment_edge[on_routing],
+        'segment_index': segment_index[on_routing],
+    }
+    for name, values in zip(attributes, sums):
+        routing[name] = values.astype(dtype, copy=False)
+
+    return routing
+
+
+
+
+def path_from_predecessors(predecessors, target):
+    """
+    Rebuilds the path from the source of a predecessor array to the target node (integer ids).
+    """
+
+    path = [int(target)]
+    while predecessors[path[-1]] >= 0:
+        path.append(int(predecessors[path[-1]]))
+    return path[::-1]
+
+
+
+
+def routing_path(routing, centroid_id_1, centroid_id_2):
+    """
+    Rebuilds the fastest path between two centroids from the predecessor arrays of
+    compute_routing_matrices, without a new search.
+
+    Parameters:
+    - routing: Result of compute_routing_matrices with return_predecessors=True.
+    - centroid_id_1: ID of the starting centroid (from set_1).
+    - centroid_id_2: ID of the destination centroid (from set_2).
+
+    Returns:
+    - path: List of nodes of the graph the routing was computed on.
+    - total_travel_time: Total travel time for the path in minutes.
+    """
+
+    if routing['predecessors'] is None:
+        raise ValueError("The routing was computed without return_predecessors.")
+    try:
+        i, j = routing['set_1'].index(centroid_id_1), routing['set_2'].index(centroid_id_2)
+    except ValueError:
+        raise ValueError(f"The centroids {centroid_id_1}, {centroid_id_2} are not in the routing sets.") from None
+
+    travel_time = routing['travel_time'][i, j]
+    if not np.isfinite(travel_time):
+        raise nx.NetworkXNoPath(f"No path between the centroids {centroid_id_1} and {centroid_id_2}.")
+
+    path = path_from_predecessors(routing['predecessors'][i], routing['targets'][j])
+    return [routing['nodes'][k] for k in path], float(travel_time)
+
+
+
+
+def tree_edge_flows(predecessors, targets, flows, edge_keys):
+    """
+    Loads the flows from every source to the targets onto the edges of its shortest path tree.
+
+    All trees of a block of sources are traversed at once: the flows are placed on the target nodes,
+    and the nodes are processed level by level from the deepest one upwards, each level passing its
+    accumulated load to the predecessors in one vectorized step. The load of a node is then the flow
+    on the tree edge to its predecessor.
+
+    Parameters:
+    - predecessors: Array of shape (n_sources, n_nodes) as returned by dijkstra(..., return_predecessors=True).
+    - targets: Integer ids of the target nodes.
+    - flows: Array of shape (n_sources, len(targets)) with the flow from every source to every target.
+    - edge_keys: Sorted keys lo * n_nodes + hi of the routing edges (see routing_edges).
+
+    Returns:
+    - edge_flows: Array with the total flow on every routing edge. Flows to unreachable targets are dropped.
+    """
+
+    n_sources, n_nodes = predecessors.shape
+    targets = np.asarray(targets, dtype=np.int64)
+    flows = np.asarray(flows, dtype=np.float64)
+    edge_flows = np.zeros(len(edge_keys))
+    # A batch holds up to about 16 temporaries of 8 bytes per tree node at once (the load, the children
+    # and parents, and the pointer jumping of accumulate_along_trees for the depths), so it gets 1/16
+    # of the block
+    batch_size = max(1, DIJKSTRA_BLOCK_SIZE // (16 * max(n_nodes, 1)))
+
+    for start in range(0, n_sources, batch_size):
+        pred = predecessors[start:start + batch_size]
+        offsets = np.arange(len(pred), dtype=np.int64)[:, None] * n_nodes
+
+        load = np.zeros(pred.size)
+        np.add.at(load, (offsets + targets).ravel(), flows[start:start + len(pred)].ravel())
+
+        # Nodes with a predecessor (tree edges), their flattened predecessor and their depth in the tree
+        children = np.flatnonzero(pred.ravel() >= 0)
+        parents = (pred.ravel()[children] + children - children % n_nodes).astype(np.int64)
+        depth = accumulate_along_trees(pred, edge_keys, np.ones((1, len(edge_keys))))[0].ravel()[children]
+
+        order = np.argsort(-depth, kind='stable')
+        children, parents, depth = children[order], parents[order], depth[order]
+        levels = np.flatnonzero(np.diff(depth)) + 1
+        for level_children, level_parents in zip(np.split(children, levels), np.split(parents, levels)):
+            np.add.at(load, level_parents, load[level_children])
+
+        nodes, pred_nodes = children % n_nodes, parents % n_nodes
+        edges = np.searchsorted(edge_keys, np.minimum(nodes, pred_nodes) * n_nodes + np.maximum(nodes, pred_nodes))
+        edge_flows += np.bincount(edges, weights=load[children], minlength=len(edge_keys))
+
+    return edge_flows
+
+
+
+
+def assign_flows(gdfNet, routing, flows):
+    """
+    Assigns an origin-destination flow matrix (e.g. the commuting matrix) to the network segments,
+    all-or-nothing along the fastest paths.
+
+    The shortest path trees of the routing pass are reused, so no new search is run, and the flows
+    of all origin-destination pairs are loaded by vectorized tree traversal (see tree_edge_flows).
+
+    Parameters:
+    - gdfNet: GeoDataFrame of the network segments the graph was built from.
+    - routing: Result of compute_routing_matrices with return_predecessors=True.
+    - flows: Array of shape (len(set_1), len(set_2)) with the flow from every origin to every destination.
+
+    Returns:
+    - gdfFlows: Copy of gdfNet with the total flow on every segment in the 'flow' column.
+    """
+
+    print("Assigning flows to the network")
+
+    if routing['predecessors'] is None:
+        raise ValueError("The routing was computed without return_predecessors.")
+    flows = np.asarray(flows, dtype=np.float64)
+    if flows.shape != routing['travel_time'].shape:
+        raise ValueError(f"The flow matrix has shape {flows.shape}, the routing {routing['travel_time'].shape}.")
+
+    unassigned = flows[~np.isfinite(routing['travel_time'])].sum()
+    if unassigned > 0:
+        print(f"\tFlow between unconnected centroids not assigned: {unassigned}.")
+
+    edge_flows = tree_edge_flows(routing['predecessors'], routing['targets'], flows, routing['edge_keys'])
+
+    gdfFlows = gdfNet.copy()
+    gdfFlows['flow'] = np.bincount(routing['segment_index'], weights=edge_flows[routing['segment_edge']], minlength=len(gdfNet))
+
+    print(f"\tSegments with flow: {np.count_nonzero(gdfFlows['flow'])} out of {len(gdfFlows)}.")
+
+    return gdfFlows
+
+
+
+
+def load_flow_matrix(file_path, centroid_ids):
+    """
+    Loads a wide origin-destination flow matrix (rows and columns labelled with the centroid IDs,
+    like commuting_wide_poland.csv) in the order of centroid_ids. Missing centroids get no flow.
+    """
+
+    print("Loading flow matrix")
+    flows = pd.read_csv(file_path, sep=';', index_col=0, dtype={0: str})
+    flows.index = flows.index.astype(str)
+    flows.columns = flows.columns.astype(str)
+    return flows.reindex(index=centroid_ids, columns=centroid_ids, fill_value=0).to_numpy(dtype=float)
+
+
+
+
+def plot_flows(gdfFlows, file_name):
+    """
+    Plots the network with the line width of every segment proportional to its flow.
+    """
+
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(10, 10))
+    gdfFlows.plot(ax=ax, color='lightgray', linewidth=0.3)
+    loaded = gdfFlows[gdfFlows['flow'] > 0]
+    if len(loaded):
+        loaded.plot(ax=ax, column='flow', cmap='Reds', linewidth=0.5 + 4.5 * loaded['flow'] / loaded['flow'].max(), legend=True)
+    ax.set_title("Assigned flows")
+    ax.set_axis_off()
+    plt.savefig(file_name, format='png', bbox_inches='tight')
+    plt.close(fig)
+
+
+
+
+def lines_to_edge_delta(gdfLines, G, default_speed, snap_distance=100):
+    """
+    Converts new lines (e.g. a proposed railway alignment) into an edge delta for the graph G.
+
+    Every LineString becomes one edge between its endpoints. Endpoints within snap_distance metres
+    of a network node of G are attached to that node; the others become new nodes, shared by lines
+    that end at the same point.
+
+    Parameters:
+    - gdfLines: GeoDataFrame of the new lines in EPSG:3035, optionally with a 'maxspeed' column.
+    - G: NetworkX graph of the base network (nodes are coordinate tuples).
+    - default_speed: Speed in km/h for lines without a valid 'maxspeed'.
+    - snap_distance: Maximum distance in metres between a line endpoint and the network node it is attached to.
+
+    Returns:
+    - edge_delta: List of (u, v, attributes) tuples for update_travel_time_matrix.
+    """
+
+    network_nodes = [node for node, data in G.nodes(data=True) if 'centroid_id' not in data]
+    tree = cKDTree(np.asarray(network_nodes, dtype=float))
+
+    speeds = pd.to_numeric(gdfLines['maxspeed'], errors='coerce') if 'maxspeed' in gdfLines else pd.Series(np.nan, index=gdfLines.index)
+    speeds = speeds.where(speeds > 0, default_speed).to_numpy(dtype=float)
+
+    edge_delta = []
+    for geom, speed in zip(gdfLines.geometry, speeds):
+        if not isinstance(geom, shapely.LineString):
+            continue
+        endpoints = []
+        for point in (geom.coords[0], geom.coords[-1]):
+            distance, nearest = tree.query(point[:2])
+            endpoints.append(network_nodes[nearest] if distance <= snap_distance else tuple(point[:2]))
+        edge_delta.append((endpoints[0], endpoints[1], {'travel_time': ((geom.length / 1000) / speed) * 60}))
+
+    return edge_delta
+
+
+
+
+def graph_edge_delta(G_base, G_scenario, weight='travel_time'):
+    """
+    Returns the edges of the scenario graph that are new or faster than in the base graph.
+
+    The incremental update only handles changes that shorten paths, so a ValueError is raised
+    if an edge of the base graph is missing or slower in the scenario graph. Both graphs must
+    therefore share the base noding and centroid connectors (e.g. the scenario graph is the base
+    graph with the new lines added), and neither should be contracted.
+    """
+
+    for u, v, w in G_base.edges(data=weight):
+        if not G_scenario.has_edge(u, v) or G_scenario[u][v][weight] > w:
+            raise ValueError(f"The edge {u} - {v} of the base graph is missing or slower in the scenario graph.")
+
+    return [(u, v, data) for u, v, data in G_scenario.edges(data=True) if not G_base.has_edge(u, v) or data[weight] < G_base[u][v][weight]]
+
+
+
+
+def update_travel_time_matrix(G, travel_time_matrix, set_1, set_2, edge_delta, weight='travel_time', n_workers=1):
+    """
+    Updates the travel time matrix of the graph G after new edges are added or edges become faster.
+
+    A shortest path that got shorter uses at least one changed edge, so it passes through a node
+    where the changed edges meet the rest of the graph (or starts at a centroid attached by a changed
+    edge). Only these boundary nodes are searched from, in the updated graph, and every pair is
+    updated as min(old travel time, via the closest boundary node). The result equals a full
+    recomputation on the updated graph.
+
+    Parameters:
+    - G: NetworkX graph the matrix was computed on. The edge delta is applied to it in place.
+    - travel_time_matrix: Matrix computed on G for set_1 x set_2 (square or condensed form).
+    - set_1: List of centroid IDs corresponding to the rows of the matrix.
+    - set_2: List of centroid IDs corresponding to the columns of the matrix.
+    - edge_delta: List of (u, v, attributes) tuples, e.g. from lines_to_edge_delta or graph_edge_delta.
+    - weight: Name of the edge attribute used as the edge weight.
+    - n_workers: Number of worker processes for the searches from the boundary nodes.
+
+    Returns:
+    - travel_time_matrix: Updated 2D NumPy array.
+    """
+
+    print("Updating travel time matrix")
+
+    if travel_time_matrix.ndim == 1:
+        travel_time_matrix = expand_condensed_matrix(travel_time_matrix)
+
+    for u, v, data in edge_delta:
+        if G.has_edge(u, v) and data[weight] > G[u][v][weight]:
+            raise ValueError(f"The edge {u} - {v} gets slower; only changes that shorten paths can be applied incrementally.")
+    G.add_edges_from(edge_delta)
+
+    changed_edges = {frozenset((u, v)) for u, v, data in edge_delta}
+    changed_nodes = {node for u, v, data in edge_delta for node in (u, v)}
+    boundary = [node for node in changed_nodes
+                if 'centroid_id' in G.nodes[node] or any(frozenset((node, nbr)) not in changed_edges for nbr in G[node])]
+
+    print(f"\tSearching from {len(boundary)} boundary nodes instead of {len(set_1)} centroids.")
+
+    arrays = graph_to_arrays(G, weight=weight)
+    csr = arrays_to_csr(arrays, weight=weight)
+    node_index = arrays['node_index']
+    targets = [node_index[centroid_node(G, cid)] for cid in list(set_1) + list(set_2)]
+    distances = dijkstra_travel_times(csr, [node_index[node] for node in boundary], targets, n_workers=n_workers)
+
+    updated = np.array(travel_time_matrix, dtype=np.float64)
+    for d in distances:
+        np.minimum(updated, d[:len(set_1), None] + d[None, len(set_1):], out=updated)
+
+    return updated.astype(travel_time_matrix.dtype, copy=False)
+
+
+
+
+def speed_parameter_grid(default_speed=(None,), connector_speed=(30,), class_multipliers=({},)):
+    """
+    Builds the parameter sets of a sensitivity sweep as the full grid of the given values.
+
+    Parameters:
+    - default_speed: Speeds in km/h for the segments without a usable 'maxspeed' (None keeps the speed
+      assigned by upload_shapefile).
+    - connector_speed: Speeds in km/h on the centroid connections.
+    - class_multipliers: Dictionaries class -> factor applied to the speeds of the segments of each class.
+
+    Returns:
+    - parameter_sets: List of dictionaries with the keys 'default_speed', 'connector_speed' and 'class_multipliers'.
+    """
+
+    return [{'default_speed': speed, 'connector_speed': connector, 'class_multipliers': dict(multipliers)}
+            for speed, connector, multipliers in itertools.product(default_speed, connector_speed, class_multipliers)]
+
+
+
+
+def sweep_edge_travel_times(edges, parameters, classes=()):
+    """
+    Computes the travel time in minutes of every edge of the sweep topology for one parameter set.
+
+    Parameters:
+    - edges: Dictionary of edge arrays as built by sweep_travel_time_matrices ('length' in km,
+      'maxspeed', 'speed_is_default', 'is_connection' and the integer 'edge_class').
+    - parameters: One parameter set as returned by speed_parameter_grid.
+    - classes: Class names in the order of the 'edge_class' codes.
+
+    Returns:
+    - travel_time: Array with the travel time of every edge.
+    """
+
+    speed = np.array(edges['maxspeed'], dtype=np.float64)
+    if parameters.get('default_speed') is not None:
+        speed[np.asarray(edges['speed_is_default'], dtype=bool)] = parameters['default_speed']
+    for edge_class, factor in parameters.get('class_multipliers', {}).items():
+        speed[np.asarray(edges['edge_class']) == list(classes).index(edge_class)] *= factor
+    speed[np.asarray(edges['is_connection'], dtype=bool)] = parameters.get('connector_speed', 30)
+    return edges['length'] / speed * 60
+
+
+
+
+# Edge arrays of the sweep topology and the routing setup in a worker process (see sweep_travel_time_matrices)
+_sweep_edges = {}
+_sweep_setup = {}
+
+
+def _init_sweep_worker(arrays_dir, names, setup):
+    """
+    Initializes a worker process by memory-mapping the sweep edge arrays written by sweep_travel_time_matrices.
+    """
+
+    global _sweep_edges, _sweep_setup
+    _sweep_edges = {name: np.load(os.path.join(arrays_dir, name + '.npy'), mmap_mode='r') for name in names}
+    _sweep_setup = setup
+
+
+def _sweep_matrix(parameters, edges=None, setup=None):
+    edges = _sweep_edges if edges is None else edges
+    setup = _sweep_setup if setup is None else setup
+    travel_time = sweep_edge_travel_times(edges, parameters, setup['classes'])
+    arrays = {'nodes': range(setup['n_nodes']), 'u': edges['u'], 'v': edges['v'], 'travel_time': travel_time}
+    return dijkstra_travel_times(arrays_to_csr(arrays), setup['sources'], setup['targets']).astype(setup['dtype'])
+
+
+
+
+@contextmanager
+def sweep_pool(edges, setup, n_workers):
+    """
+    Opens a process pool whose workers memory-map the sweep edge arrays from a temporary directory.
+    """
+
+    with tempfile.TemporaryDirectory(prefix='travel_time_sweep_') as arrays_dir:
+        for name, values in edges.items():
+            np.save(os.path.join(arrays_dir, name + '.npy'), values)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_sweep_worker, initargs=(arrays_dir, tuple(edges), setup)) as executor:
+            yield executor
+
+
+
+
+def sweep_travel_time_matrices(gdfNet, gdfConnections, powiaty_codes, parameter_sets, set_1=None, set_2=None,
+                               class_column=None, n_workers=1, dtype=np.float32):
+    """
+    Computes the travel time matrices for a grid of speed parameters, building the topology once.
+
+    The graph arrays and the edge lengths are created once from the prepared network; every parameter
+    set only re-weights the edges (see sweep_edge_travel_times) and reruns the batched Dijkstra.
+    With n_workers > 1 the parameter sets run in a process pool whose workers memory-map the edge
+    arrays. The uncontracted graph is used, as the fastest of parallel chains depends on the speeds.
+
+    Parameters:
+    - gdfNet: GeoDataFrame of the prepared network with 'maxspeed' and 'speed_is_default' columns
+      (see upload_shapefile).
+    - gdfConnections: GeoDataFrame of the centroid connections.
+    - powiaty_codes: List of centroid IDs, as for create_graph_arrays.
+    - parameter_sets: List of parameter sets as returned by speed_parameter_grid.
+    - set_1, set_2: Lists of centroid IDs of the origins and destinations (all centroids by default).
+    - class_column: gdfNet column with the class of each segment the class_multipliers refer to.
+    - n_workers: Number of worker processes.
+    - dtype: dtype of the returned matrices.
+
+    Returns:
+    - sweep: Dictionary with the stacked travel time matrices ('travel_time', shape (len(parameter_sets),
+      len(set_1), len(set_2))), the 'parameters' as a DataFrame with one row per set (a 'multiplier_<class>'
+      column per class), the centroid IDs ('set_1', 'set_2') and the parameter sets themselves ('parameter_sets').
+    """
+
+    print("Computing speed parameter sweep")
+
+    set_1 = list(powiaty_codes) if set_1 is None else list(set_1)
+    set_2 = list(powiaty_codes) if set_2 is None else list(set_2)
+    if any(parameters.get('default_speed') is not None for parameters in parameter_sets) and 'speed_is_default' not in gdfNet:
+        raise ValueError("Sweeping the default speed requires the 'speed_is_default' column of upload_shapefile.")
+    if any(parameters.get('class_multipliers') for parameters in parameter_sets) and class_column is None:
+        raise ValueError("Class multipliers require a class_column.")
+
+    arrays = create_graph_arrays(gdfNet, gdfConnections, powiaty_codes)
+    sources = centroid_node_ids(arrays, set_1)
+    targets = centroid_node_ids(arrays, set_2)
+
+    is_connection = arrays['edge_index'] < 0
+    segment = np.where(is_connection, 0, arrays['edge_index'])
+    classes = sorted({edge_class for parameters in parameter_sets for edge_class in parameters.get('class_multipliers', {})}, key=str)
+    edge_class = (pd.Categorical(gdfNet[class_column].to_numpy()[segment], categories=classes).codes
+                  if class_column is not None else np.full(len(segment), -1))
+    edges = {
+        'u': arrays['u'],
+        'v': arrays['v'],
+        'length': arrays['length'],
+        'maxspeed': gdfNet['maxspeed'].to_numpy(dtype=float)[segment],
+        'speed_is_default': gdfNet['speed_is_default'].to_numpy(dtype=bool)[segment] & ~is_connection
+                            if 'speed_is_default' in gdfNet else np.zeros(len(segment), dtype=bool),
+        'is_connection': is_connection,
+        'edge_class': np.where(is_connection, -1, edge_class),
+    }
+
+    setup = {'n_nodes': len(arrays['nodes']), 'sources': sources, 'targets': targets, 'classes': classes, 'dtype': dtype}
+    matrices = np.empty((len(parameter_sets), len(set_1), len(set_2)), dtype=dtype)
+
+    with (sweep_pool(edges, setup, n_workers) if n_workers > 1 else nullcontext()) as executor:
+        if executor is None:
+            results = (_sweep_matrix(parameters, edges, setup) for parameters in parameter_sets)
+        else:
+            results = executor.map(_sweep_matrix, parameter_sets)
+
+        for p, matrix in enumerate(results):
+            print(f"\tParameter set {p} out of {len(parameter_sets)}.")
+            matrices[p] = matrix
+
+    parameters = pd.DataFrame([{'default_speed': parameters.get('default_speed'),
+                                'connector_speed': parameters.get('connector_speed', 30),
+                                **{f'multiplier_{edge_class}': parameters.get('class_multipliers', {}).get(edge_class, 1.0) for edge_class in classes}}
+                               for parameters in parameter_sets])
+
+    return {'travel_time': matrices, 'parameters': parameters, 'set_1': set_1, 'set_2': set_2, 'parameter_sets': list(parameter_sets)}
+
+
+
+
+def save_sweep(file_path, sweep):
+    """
+    Saves the stacked matrices of a sweep to file_path (.npz) with the centroid IDs and the
+    parameter sets as JSON metadata.
+    """
+
+    print("Saving speed parameter sweep")
+    metadata = {'set_1': sweep['set_1'], 'set_2': sweep['set_2'], 'parameter_sets': sweep['parameter_sets']}
+    np.savez(file_path, travel_time=sweep['travel_time'], metadata=json.dumps(metadata, default=str))
+
+
+
+
+def color_counties(shapefile_path, color_values, write_path):
+    """
+    Colors the counties in Poland according to the numbers passed in the list.
+
+    Parameters:
+    - shapefile_path: Path to the shapefile containing the administrative borders of counties.
+    - color_values: List of numbers used to color the counties. The order should match the order of the counties in the shapefile.
+    """
+
+    import matplotlib.pyplot as plt
+
+    # Load the shapefile using GeoPandas
+    try:
+        gdf = gpd.read_file(shapefile_path)
+    except FileNotFoundError:
+        print(f"File not found: {shapefile_path}")
+
+    
+    # Ensure the color_values list is the same alength as the number of counties
+    if len(color_values) != len(gdf):
+        raise ValueError("The length of the color_values list must match the number of counties in the shapefile.")
+    
+    # Add the color values to the GeoDataFrame
+    gdf['color_value'] = color_values
+
+    cmap = plt.cm.viridis  # Use green colormap
+    
+    # Normalize the color values to a colormap range
+    norm = plt.Normalize(vmin=min(color_values), vmax=max(color_values))
+    
+    # Plot the counties with the assigned colors
+    fig, ax = plt.subplots(1, 1, figsize=(10, 10))
+    gdf.plot(column='color_value', cmap=cmap, linewidth=0.8, ax=ax, edgecolor='0.8')
+    
+    # Add a colorbar
+    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
+    sm.set_array([])
+    fig.colorbar(sm, ax=ax)
+    
+    # Set title and show plot
+    plt.title("Poland: Counties (Powiaty) Colored by Distance from an Example Origin")
+    
+    # Save plot
+    plt.savefig(write_path, bbox_inches='tight')
+    plt.close(fig)
+    print(f"\nPlot saved to {write_path}")
 
 
 
@@ -436,6 +2587,10 @@ def color_counties(shapefile_path, color_values, write_path):
 
 def save(data_input_path, file, travel_time_matrix):
     print("Saving travel time matrix to csv")
+    if issparse(travel_time_matrix):
+        raise TypeError("Convert the cutoff-bounded sparse matrix with sparse_to_dense before saving it.")
+    if travel_time_matrix.ndim == 1:
+        travel_time_matrix = expand_condensed_matrix(travel_time_matrix)
     try:
         np.savetxt(data_input_path + file + '.csv', travel_time_matrix, delimiter=',')
     except Exception as e:
@@ -449,44 +2604,694 @@ def save(data_input_path, file, travel_time_matrix):
 
 
 
-def main():
-    railway_speed = 90
-    road_speed = 56
+def network_cache_key(input_files, params):
+    """
+    Computes the content-addressed cache key of a prepared network.
+
+    Parameters:
+    - input_files: Paths of the input shapefiles, with or without the .shp extension; the contents of all
+      their component files (.shp, .shx, .dbf, .prj, .cpg) are hashed. Paths of other files are hashed as they are.
+    - params: Dictionary of the parameters of the preparation (e.g. the default speed).
+
+    Returns:
+    - key: Hexadecimal SHA-256 digest of the input contents, the parameters and CACHE_VERSION.
+    """
 
-    resources_config = [
-        #("poland-railway-rail-220101", "travel-time-matrix-2021-railway", railway_speed),
-        # ("poland-railway-future", "travel-time-matrix-future-railway", railway_speed),
-        # ("poland-railway-future_counterfactual", "travel-time-matrix-future-railway-counterfactual", railway_speed),
-        # ("poland-railway-future_counterfactual2", "travel-time-matrix-future-railway-counterfactual2", railway_speed),
-        # ("poland-railway-future_counterfactual3", "travel-time-matrix-future-railway-counterfactual3", railway_speed),
-        # ("poland-highway-roads-220101", "travel-time-matrix-2021-highway", road_speed),
-        ("poland-highway-future", "travel-time-matrix-future-highway", road_speed)
-    ]
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': CACHE_VERSION, 'params': params}, sort_keys=True, default=str).encode())
+    for input_file in input_files:
+        # A path given with a component extension (e.g. zones.shp) still hashes the .dbf of the attributes
+        base, extension = os.path.splitext(input_file)
+        if extension.lower() in SHAPEFILE_EXTENSIONS:
+            input_file = base
+        for extension in ('', *SHAPEFILE_EXTENSIONS):
+            path = input_file + extension
+            if not os.path.isfile(path):
+                continue
+            digest.update(os.path.basename(path).encode())
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**24), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
 
-    root_path = "E:/Studia/Studia magisterskie/Wirtschaftwissenschaft/Quantitative Spatial Economics/Central-Communication-Port-Appraisal/shape/"
-    data_input_path = "E:/Studia/Studia magisterskie/Wirtschaftwissenschaft/Quantitative Spatial Economics/Central-Communication-Port-Appraisal/data/input/"
-    plots_path = "E:/Studia/Studia magisterskie/Wirtschaftwissenschaft/Quantitative Spatial Economics/Central-Communication-Port-Appraisal/figs/travel_matrix_computation/"
 
-    gdfCentroids = upload_centroids(root_path)
-    plot_gdf(gdfCentroids, plots_path + "centroids.png")
-    
-    for resource in resources_config:
-        file, write_file, default_speed = resource
-        gdfNet = upload_shapefile(file, default_speed, root_path)
-        
-        plot_gdf(gdfNet, plots_path + file + ".png")
-        gdfNet = prepare_network_shapefile(gdfNet)
-        plot_gdf(gdfNet, plots_path + file + "_biggest_component.png")
-        gdfConnections, powiaty_codes = prepare_centroids_for_conversion_into_graph(gdfNet, gdfCentroids)
-        plot_network_with_connections(gdfNet, gdfConnections, gdfCentroids, file_name = plots_path + file + "_with_centroids.png")
-        G = create_nx_graph(gdfNet, gdfConnections, powiaty_codes)
-        path, travel_time = shortest_path_between_centroids(G, centroid_id_1=powiaty_codes[10], centroid_id_2=powiaty_codes[144])
-        plot_shortest_path(path, travel_time, gdfNet, file_name = plots_path + file + "example_path.png")
-        travel_time_matrix = compute_travel_time_matrix(G, powiaty_codes, powiaty_codes)
-        color_values = travel_time_matrix[179, :]
-        color_counties(root_path + 'powiaty.shp', color_values, plots_path + file + "_example_distances.png")
-        
-        save(data_input_path, file, travel_time_matrix)
+
+
+def store_network_cache(cache_dir, key, gdfNet, gdfConnections, arrays, powiaty_codes, max_bytes=None):
+    """
+    Stores the cleaned network and the centroid connections as GeoParquet and the graph arrays
+    as .npz under cache_dir/key, then evicts old entries (see evict_cache).
+    """
+
+    print("Storing prepared network in cache")
+    try:
+        entry_tmp = tempfile.mkdtemp(prefix=key + '.', dir=_makedirs(cache_dir))
+        gdfNet.to_parquet(os.path.join(entry_tmp, 'network.parquet'))
+        gdfConnections.to_parquet(os.path.join(entry_tmp, 'connections.parquet'))
+        centroid_codes = list(arrays['centroid_index'])
+        np.savez(os.path.join(entry_tmp, 'graph.npz'),
+                 coords=np.asarray(arrays['nodes'], dtype=float), u=arrays['u'], v=arrays['v'],
+                 travel_time=arrays['travel_time'], edge_index=arrays['edge_index'], connection_idx=arrays['connection_idx'],
+                 edge_attributes=np.asarray(arrays['edge_attributes'], dtype=str),
+                 **{'attribute_' + name: arrays[name] for name in arrays['edge_attributes']},
+                 centroid_codes=np.asarray(centroid_codes),
+                 centroid_nodes=np.asarray([arrays['centroid_index'][code] for code in centroid_codes], dtype=np.int64),
+                 powiaty_codes=np.asarray(powiaty_codes))
+
+        publish_cache_entry(cache_dir, key, entry_tmp)
+    except ImportError as e:
+        print(f"Cache disabled: {e}")
+        return
+
+    if max_bytes is not None:
+        evict_cache(cache_dir, max_bytes)
+
+
+
+
+def load_network_cache(cache_dir, key):
+    """
+    Loads a prepared network stored by store_network_cache.
+
+    Returns:
+    - (gdfNet, gdfConnections, arrays, powiaty_codes), or None if the key is not cached.
+    """
+
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+
+    print("Loading prepared network from cache")
+    try:
+        gdfNet = gpd.read_parquet(os.path.join(entry, 'network.parquet'))
+        gdfConnections = gpd.read_parquet(os.path.join(entry, 'connections.parquet'))
+    except ImportError as e:
+        print(f"Cache disabled: {e}")
+        return None
+
+    with np.load(os.path.join(entry, 'graph.npz')) as graph:
+        nodes = list(map(tuple, graph['coords'].tolist()))
+        arrays = {
+            'nodes': nodes,
+            'node_index': {node: i for i, node in enumerate(nodes)},
+            'u': graph['u'], 'v': graph['v'], 'travel_time': graph['travel_time'],
+            'edge_index': graph['edge_index'], 'connection_idx': graph['connection_idx'],
+            'edge_attributes': tuple(graph['edge_attributes'].tolist()),
+            'centroid_index': dict(zip(graph['centroid_codes'].tolist(), graph['centroid_nodes'].tolist())),
+        }
+        for name in arrays['edge_attributes']:
+            arrays[name] = graph['attribute_' + name]
+        powiaty_codes = graph['powiaty_codes'].tolist()
+
+    # The modification time of the entry records its last use for the eviction
+    os.utime(entry)
+
+    return gdfNet, gdfConnections, arrays, powiaty_codes
+
+
+
+
+def evict_cache(cache_dir, max_bytes):
+    """
+    Removes the least recently used cache entries until the cache takes at most max_bytes.
+    The most recently used entry is always kept. Only published entries (with their manifest) are
+    evicted; the temporary directories of entries still being written by other jobs are left alone.
+    """
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if '.' not in name and os.path.isfile(os.path.join(entry, CACHE_MANIFEST)):
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(entry) for f in files)
+            entries.append((os.path.getmtime(entry), size, entry))
+
+    total = sum(size for mtime, size, entry in entries)
+    for mtime, size, entry in sorted(entries)[:-1]:
+        if total <= max_bytes:
+            break
+        print(f"\tEvicting {entry} from cache")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+
+
+def publish_cache_entry(cache_dir, key, entry_tmp):
+    """
+    Moves a cache entry written to the temporary directory entry_tmp to cache_dir/key, with its manifest.
+
+    The move is atomic, so an interrupted run never leaves a partial entry. If another job published
+    the same key first, its entry (computed from the same inputs) is kept and entry_tmp is removed.
+    """
+
+    with open(os.path.join(entry_tmp, CACHE_MANIFEST), 'w') as f:
+        json.dump({'key': key, 'version': CACHE_VERSION, 'created': datetime.now().isoformat(timespec='seconds')}, f)
+
+    entry = os.path.join(cache_dir, key)
+    try:
+        os.replace(entry_tmp, entry)
+    except OSError:
+        if not os.path.isdir(entry):
+            raise
+        shutil.rmtree(entry_tmp, ignore_errors=True)
+
+
+
+
+def _makedirs(path):
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+
+
+# Instrumentation of the run (see start_run_report); None disables it, so stage and
+# batch_progress only cost a function call
+_run_report = None
+
+
+def start_run_report(profile=False, trace_memory=False, **info):
+    """
+    Enables the instrumentation of the run: from now on every stage records its wall time, CPU time,
+    peak memory and sizes, and the routing loops report their throughput and ETA.
+
+    Parameters:
+    - profile: If True, the whole run is profiled with cProfile (saved by finish_run_report).
+    - trace_memory: If True, the peak of the Python allocations of every stage is traced with
+      tracemalloc (slows down the Python-heavy stages; the peak RSS is always recorded).
+    - info: Further information stored in the report, e.g. the settings of the run.
+    """
+
+    global _run_report
+    _run_report = {
+        'info': {'created': datetime.now().isoformat(timespec='seconds'), 'platform': platform.platform(),
+                 'python': platform.python_version(), 'cpu_count': os.cpu_count(), **info},
+        'stages': [],
+        'open': [],
+        'trace_memory': trace_memory,
+        'profiler': cProfile.Profile() if profile else None,
+        'started': time.perf_counter(),
+    }
+    if trace_memory:
+        tracemalloc.start()
+    if profile:
+        _run_report['profiler'].enable()
+
+
+
+
+def _peak_rss_mb():
+    """
+    Returns the peak resident memory in MB of the process and of its terminated worker processes
+    (None where it cannot be measured).
+    """
+
+    if resource is not None:
+        scale = 2**20 if sys.platform == 'darwin' else 2**10  # ru_maxrss is in bytes on macOS, in KB elsewhere
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+    if psutil is not None and hasattr(psutil.Process().memory_info(), 'peak_wset'):
+        return psutil.Process().memory_info().peak_wset / 2**20, None
+    return None, None
+
+
+
+
+def _workers_cpu_s():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+
+
+def _fold_traced_peak():
+    # Keeps the tracemalloc peak of all open stages before it is reset for a nested stage
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    for record in _run_report['open']:
+        record['python_peak_mb'] = max(record.get('python_peak_mb', 0.0), peak)
+    tracemalloc.reset_peak()
+
+
+
+
+def stage(name, **sizes):
+    """
+    Measures one stage of the run.
+
+    Parameters:
+    - name: Name of the stage. Stages may be nested; the record keeps the name of the enclosing one.
+    - sizes: Sizes known when the stage starts, e.g. segments=len(gdfNet).
+
+    Returns:
+    - context: Context manager yielding the record of the stage, to which sizes known only at its end
+      can be added (record['edges'] = ...). Without a run report it is a nullcontext yielding a
+      throwaway dictionary.
+    """
+
+    if _run_report is None:
+        return nullcontext({})
+    return _measure_stage(name, sizes)
+
+
+
+
+@contextmanager
+def _measure_stage(name, sizes):
+    report = _run_report
+    record = {'stage': name, 'parent': report['open'][-1]['stage'] if report['open'] else None,
+              'start_s': time.perf_counter() - report['started'], **sizes}
+    if report['trace_memory']:
+        _fold_traced_peak()
+    report['open'].append(record)
+
+    peak_before, _ = _peak_rss_mb()
+    workers_cpu = _workers_cpu_s()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.process_time() - cpu
+        if workers_cpu is not None:
+            record['workers_cpu_s'] = _workers_cpu_s() - workers_cpu
+        peak, workers_peak = _peak_rss_mb()
+        if peak is not None:
+            record['peak_rss_mb'] = peak
+            record['peak_rss_increase_mb'] = peak - peak_before
+        if workers_peak is not None:
+            record['workers_peak_rss_mb'] = workers_peak
+        if report['trace_memory']:
+            _fold_traced_peak()
+        report['open'].pop()
+        report['stages'].append(record)
+        print(f"\t[{name}] {record['wall_s']:.2f} s wall, {record['cpu_s']:.2f} s CPU"
+              + (f", peak RSS {peak:.0f} MB." if peak is not None else "."))
+
+
+
+
+def batch_progress(n_batches, n_rows, unit='sources'):
+    """
+    Returns the function progress(b, rows) that reports the end of batch b (of rows rows) of a routing loop.
+
+    Without a run report it prints the batch number only. With a run report it adds the throughput
+    and the estimated time to the end of the loop, and records the throughput in the current stage.
+    """
+
+    started = time.perf_counter()
+    rows_done = 0
+
+    def progress(b, rows):
+        nonlocal rows_done
+        if _run_report is None:
+            print(f"\tBatch {b} out of {n_batches}.")
+            return
+        rows_done += rows
+        elapsed = time.perf_counter() - started
+        throughput = rows_done / elapsed if elapsed > 0 else float('inf')
+        eta = (n_rows - rows_done) / throughput if throughput > 0 else float('inf')
+        print(f"\tBatch {b} out of {n_batches}: {throughput:.1f} {unit}/s, ETA {eta:.0f} s.")
+        if _run_report['open']:
+            _run_report['open'][-1].update({'routed_' + unit: rows_done, unit + '_per_s': throughput})
+
+    return progress
+
+
+
+
+def finish_run_report(report_path=None):
+    """
+    Disables the instrumentation and returns the run report.
+
+    Parameters:
+    - report_path: Optional path of the JSON report. With profiling, the cProfile statistics are
+      saved next to it with the extension .prof (readable with pstats or snakeviz).
+
+    Returns:
+    - report: Dictionary with the run information, the total wall time ('wall_s') and the records of
+      the stages in the order they finished ('stages'), or None if no run report was started.
+    """
+
+    global _run_report
+    report, _run_report = _run_report, None
+    if report is None:
+        return None
+
+    if report['profiler'] is not None:
+        report['profiler'].disable()
+    if report['trace_memory']:
+        tracemalloc.stop()
+
+    result = {**report['info'], 'wall_s': time.perf_counter() - report['started'], 'stages': report['stages']}
+    if report_path:
+        _makedirs(os.path.dirname(report_path) or '.')
+        if report['profiler'] is not None:
+            result['profile'] = os.path.splitext(report_path)[0] + '.prof'
+            report['profiler'].dump_stats(result['profile'])
+        with open(report_path, 'w') as f:
+            json.dump(result, f, indent=2, default=str)
+        print(f"Run report saved to {report_path}")
+    return result
+
+
+
+
+# Diagnostic plots written for every scenario; --plots selects a subset and --no-plots skips them all
+PLOTS = ('centroids', 'network', 'component', 'connections', 'path', 'counties', 'flows')
+
+# Run settings, overridden by the "settings" of the scenario config and by the command line
+DEFAULT_SETTINGS = {
+    'n_tiles': 8,
+    'cache_max_bytes': 20 * 2**30,
+    'write_csv': True,
+    'region_bbox': None,  # (xmin, ymin, xmax, ymax) in EPSG:3035 to run a regional subset
+    'run_sweep': False,
+    'flows_file': None,  # flow matrix in the input directory (e.g. commuting_wide_poland.csv) to assign; null skips it
+}
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_scenarios(config_path, names=None):
+    """
+    Reads a scenario config file.
+
+    The file is a JSON object with the run "settings" (see DEFAULT_SETTINGS) and the list of
+    "scenarios", each with the network shapefile name ("network"), the name of its matrix in the
+    MATLAB scripts ("matrix") and the speed of the segments without maxspeed ("default_speed").
+
+    Parameters:
+    - config_path: Path of the JSON file (e.g. scripts/scenarios.json).
+    - names: Optional network or matrix names of the scenarios to run (all if None).
+
+    Returns:
+    - settings: DEFAULT_SETTINGS updated with the settings of the file.
+    - scenarios: List of the selected scenario dictionaries, in the order of the file.
+    """
+
+    with open(config_path) as f:
+        config = json.load(f)
+
+    settings = {**DEFAULT_SETTINGS, **config.get('settings', {})}
+    scenarios = config['scenarios']
+    if names:
+        unknown = [name for name in names if not any(name in (s['network'], s.get('matrix')) for s in scenarios)]
+        if unknown:
+            raise ValueError(f"Unknown scenarios {unknown}. Choose from {[s['network'] for s in scenarios]}.")
+        scenarios = [s for s in scenarios if s['network'] in names or s.get('matrix') in names]
+    return settings, scenarios
+
+
+
+
+def prepare_scenario_network(scenario, gdfCentroids, settings, paths, plots=PLOTS, n_workers=1, centroids_path=None, id_column='JPT_KOD_JE'):
+    """
+    Prepares the network of one scenario with the connections of its centroids, or loads it from the cache.
+
+    Parameters:
+    - scenario: Scenario dictionary as returned by load_scenarios.
+    - gdfCentroids: GeoDataFrame of the centroids (upload_centroids) or of other zones (upload_zones).
+    - settings: Run settings (see DEFAULT_SETTINGS).
+    - paths: Dictionary with the directories 'shape', 'input', 'output', 'plots' and 'cache'.
+    - plots: Names of the diagnostic plots to write (see PLOTS).
+    - n_workers: Number of worker processes for noding.
+    - centroids_path: Path of the layer gdfCentroids was read from, part of the cache key
+      (default: powiaty_centroids of the shape directory).
+    - id_column: Column of gdfCentroids with the centroid IDs.
+
+    Returns:
+    - gdfNet, gdfConnections, arrays, powiaty_codes: The prepared network, the connections, the
+      graph arrays and the centroid IDs (see create_graph_arrays).
+    """
+
+    file, default_speed = scenario['network'], scenario['default_speed']
+    root_path, plots_path = paths['shape'], paths['plots']
+    region_bbox = settings['region_bbox']
+    centroids_path = root_path + "powiaty_centroids" if centroids_path is None else centroids_path
+
+    cache_key = network_cache_key([root_path + file, centroids_path], {'default_speed': default_speed, 'bbox': region_bbox, 'id_column': id_column})
+    with stage('load_cache') as record:
+        cached = load_network_cache(paths['cache'], cache_key)
+        record['hit'] = cached is not None
+    if cached is not None:
+        return cached
+
+    with stage('load_network') as record:
+        gdfNet = upload_shapefile(file, default_speed, root_path, bbox=region_bbox, cache_dir=paths['cache'])
+        record['segments'] = len(gdfNet)
+
+    if 'network' in plots:
+        with stage('plots'):
+            plot_gdf(gdfNet, plots_path + file + ".png")
+    gdfNet = prepare_network_shapefile(gdfNet, n_tiles=settings['n_tiles'], n_workers=n_workers)
+    if 'component' in plots:
+        with stage('plots'):
+            plot_gdf(gdfNet, plots_path + file + "_biggest_component.png")
+    with stage('connectors', segments=len(gdfNet), centroids=len(gdfCentroids)) as record:
+        gdfConnections, powiaty_codes = prepare_centroids_for_conversion_into_graph(gdfNet, gdfCentroids, id_column=id_column)
+        record['connections'] = len(gdfConnections)
+    if 'connections' in plots:
+        with stage('plots'):
+            plot_network_with_connections(gdfNet, gdfConnections, gdfCentroids, file_name = plots_path + file + "_with_centroids.png")
+    with stage('graph_arrays') as record:
+        arrays = create_graph_arrays(gdfNet, gdfConnections, powiaty_codes)
+        record.update(nodes=len(arrays['nodes']), edges=len(arrays['u']))
+    with stage('store_cache'):
+        store_network_cache(paths['cache'], cache_key, gdfNet, gdfConnections, arrays, powiaty_codes, max_bytes=settings['cache_max_bytes'])
+
+    return gdfNet, gdfConnections, arrays, powiaty_codes
+
+
+
+
+def run_scenario(scenario, gdfCentroids, settings, paths, plots=PLOTS, n_workers=1):
+    """
+    Prepares the network of one scenario (or loads it from the cache), computes its travel time and
+    distance matrices, assigns the flows and writes the outputs and the selected plots.
+
+    Parameters:
+    - scenario: Scenario dictionary as returned by load_scenarios.
+    - gdfCentroids: GeoDataFrame of the centroids as returned by upload_centroids.
+    - settings: Run settings (see DEFAULT_SETTINGS).
+    - paths: Dictionary with the directories 'shape', 'input', 'output', 'plots' and 'cache'.
+    - plots: Names of the diagnostic plots to write (see PLOTS).
+    - n_workers: Number of worker processes for noding and routing.
+
+    Outputs (in the output directory, named after the network):
+    - <network>.npy and <network>-length.npy: The travel time and distance matrices, streamed as the
+      routing proceeds (with -predecessors.npy when the flows are assigned); a rerun
+      resumes from them (see compute_routing_matrices).
+    - <network>.csv and <network>-distance.csv: Their csv export, unless write_csv is off.
+    - <network>-flows.gpkg and <network>-sweep.npz: The assigned flows and the speed sweep, if enabled.
+    """
+
+    file, default_speed = scenario['network'], scenario['default_speed']
+    root_path, plots_path, output_path = paths['shape'], paths['plots'], paths['output']
+
+    gdfNet, gdfConnections, arrays, powiaty_codes = prepare_scenario_network(scenario, gdfCentroids, settings, paths, plots=plots, n_workers=n_workers)
+
+    with stage('graph_build', nodes=len(arrays['nodes']), edges=len(arrays['u'])) as record:
+        G = arrays_to_nx_graph(arrays)
+        G = contract_degree_two_chains(G)
+        record.update(contracted_nodes=G.number_of_nodes(), contracted_edges=G.number_of_edges())
+    # The matrices are streamed to .npy files (and resumed from them); the csv files are an optional export
+    with stage('routing', sources=len(powiaty_codes), targets=len(powiaty_codes), n_workers=n_workers):
+        routing = compute_routing_matrices(G, powiaty_codes, powiaty_codes, return_predecessors=bool(settings['flows_file']),
+                                           n_workers=n_workers, out_path=output_path + file)
+    travel_time_matrix = routing['travel_time']
+    if 'path' in plots:
+        with stage('plots'):
+            # Without the trees of the flow assignment, the example path is found with one search
+            if routing['predecessors'] is not None:
+                path, travel_time = routing_path(routing, centroid_id_1=powiaty_codes[10], centroid_id_2=powiaty_codes[144])
+            else:
+                path, travel_time = shortest_path_between_centroids(G, centroid_id_1=powiaty_codes[10], centroid_id_2=powiaty_codes[144])
+            plot_shortest_path(expand_path(G, path), travel_time, gdfNet, file_name = plots_path + file + "example_path.png", segments=path_segments(G, path))
+    if 'counties' in plots:
+        with stage('plots'):
+            color_values = travel_time_matrix[179]
+            color_counties(root_path + 'powiaty.shp', color_values, plots_path + file + "_example_distances.png")
+
+    if settings['flows_file']:
+        with stage('flows', segments=len(gdfNet)):
+            gdfFlows = assign_flows(gdfNet, routing, load_flow_matrix(paths['input'] + settings['flows_file'], powiaty_codes))
+        if 'flows' in plots:
+            with stage('plots'):
+                plot_flows(gdfFlows, plots_path + file + "_flows.png")
+        with stage('save'):
+            gdfFlows.to_file(output_path + file + "-flows.gpkg", driver='GPKG')
+
+    if settings['run_sweep']:
+        parameter_sets = speed_parameter_grid(default_speed=[0.8 * default_speed, default_speed, 1.2 * default_speed], connector_speed=[20, 30, 40])
+        with stage('sweep', parameter_sets=len(parameter_sets), n_workers=n_workers):
+            sweep = sweep_travel_time_matrices(gdfNet, gdfConnections, powiaty_codes, parameter_sets, n_workers=n_workers)
+        with stage('save'):
+            save_sweep(output_path + file + "-sweep.npz", sweep)
+
+    if settings['write_csv']:
+        with stage('save'):
+            export_matrix_csv(output_path + file + '.npy', output_path + file + '.csv')
+            export_matrix_csv(output_path + file + '-length.npy', output_path + file + '-distance.csv')
+
+
+
+
+def run_zone_scenario(scenario, gdfZones, zones_path, id_column, settings, paths, zone_regions, weights=None, regions=None,
+                      plots=PLOTS, n_workers=1, origin_block=None, destination_block=4096):
+    """
+    Computes the travel time matrix of one scenario between arbitrary zones (e.g. gminas or grid
+    cells) as a tile store, and its aggregation to regions (e.g. powiaty) with the zone weights.
+
+    Parameters:
+    - scenario, settings, paths, plots, n_workers: As in run_scenario.
+    - gdfZones: GeoDataFrame of the zones as returned by upload_zones.
+    - zones_path: Path the zones were read from; its name is part of the output names.
+    - id_column: Column of gdfZones with the zone IDs.
+    - zone_regions: Region ID of every zone (see zones_to_regions).
+    - weights: Weight of every zone, e.g. its population (equal weights if None).
+    - regions: Region IDs in the order of the aggregated matrix (see aggregate_tiles).
+    - origin_block, destination_block: Tile size (see compute_travel_time_tiles).
+
+    Outputs (in the output directory, named after the network and the zone layer):
+    - <network>-<zones>-tiles: The tile store of the zone matrix.
+    - <network>-<zones>-regions.csv and -regions-ids.csv: The aggregated matrix and its region IDs.
+    """
+
+    file = scenario['network']
+    name = file + "-" + os.path.splitext(os.path.basename(zones_path))[0]
+
+    gdfNet, gdfConnections, arrays, zone_codes = prepare_scenario_network(scenario, gdfZones, settings, paths, plots=plots, n_workers=n_workers,
+                                                                          centroids_path=zones_path, id_column=id_column)
+
+    with stage('graph_build', nodes=len(arrays['nodes']), edges=len(arrays['u'])) as record:
+        G = contract_degree_two_chains(arrays_to_nx_graph(arrays))
+        record.update(contracted_nodes=G.number_of_nodes(), contracted_edges=G.number_of_edges())
+    with stage('routing', sources=len(zone_codes), targets=len(zone_codes), n_workers=n_workers):
+        compute_travel_time_tiles(G, zone_codes, zone_codes, paths['output'] + name + "-tiles", origin_block=origin_block,
+                                  destination_block=destination_block, n_workers=n_workers)
+
+    # The zones were given to the graph in the order of gdfZones
+    with stage('aggregation', zones=len(zone_codes)):
+        travel_time_matrix, regions = aggregate_tiles(paths['output'] + name + "-tiles", zone_regions, origin_weights=weights, regions=regions)
+    with stage('save'):
+        save(paths['output'], name + "-regions", travel_time_matrix)
+        pd.DataFrame({'region': regions}).to_csv(paths['output'] + name + "-regions-ids.csv", index=False)
+
+
+
+
+def parse_plots(value):
+    plots = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in plots if name not in PLOTS and name != 'all']
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown plots {unknown}. Choose from {list(PLOTS)} or 'all'.")
+    return PLOTS if 'all' in plots else tuple(plots)
+
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute the travel time and distance matrices of the transport network scenarios.",
+                                     epilog="Every scenario is independent, so a batch system can run one job per --scenario.")
+    parser.add_argument('--config', default=os.path.join(REPO_PATH, 'scripts', 'scenarios.json'), help="JSON scenario config file")
+    parser.add_argument('--scenario', action='append', help="Network or matrix name of a scenario to run (repeatable; default: all of the config)")
+    parser.add_argument('--list', action='store_true', help="List the scenarios of the config and exit")
+    parser.add_argument('--shape-dir', default=os.path.join(REPO_PATH, 'shape'), help="Directory of the network and centroid shapefiles")
+    parser.add_argument('--input-dir', default=os.path.join(REPO_PATH, 'data', 'input'), help="Directory of the flow matrix")
+    parser.add_argument('--output-dir', default=os.path.join(REPO_PATH, 'data', 'input'), help="Directory of the matrices and flows")
+    parser.add_argument('--plots-dir', default=os.path.join(REPO_PATH, 'figs', 'travel_matrix_computation'), help="Directory of the plots")
+    parser.add_argument('--cache-dir', help="Directory of the prepared network cache (default: <shape-dir>/cache)")
+    parser.add_argument('--plots', type=parse_plots, default=PLOTS, help=f"Comma-separated plots to write, from {', '.join(PLOTS)} (default: all)")
+    parser.add_argument('--no-plots', dest='plots', action='store_const', const=(), help="Write no plots")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes for noding and routing")
+    parser.add_argument('--tiles', type=int, help="Noding tiles per axis (overrides the config)")
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'), help="Region in EPSG:3035 (overrides the config)")
+    parser.add_argument('--sweep', action='store_true', help="Also compute the speed parameter sweep")
+    parser.add_argument('--flows', metavar='FILE', help="Flow matrix in the input directory to assign to the network, e.g. commuting_wide_poland.csv (overrides the config)")
+    parser.add_argument('--no-csv', action='store_true', help="Only write the .npy matrices, without their csv export")
+    parser.add_argument('--zones', help="Point or polygon layer of other zones (e.g. gminas or grid cells) to compute a tiled matrix between")
+    parser.add_argument('--zone-id', help="Column of the zone IDs (required with --zones)")
+    parser.add_argument('--zone-weight', help="Column of the zone weights (e.g. the population) for the aggregation to powiaty")
+    parser.add_argument('--zone-region', help="Column of the region of every zone (default: the powiat of powiaty.shp the zone lies in)")
+    parser.add_argument('--tile-size', type=int, nargs=2, metavar=('ORIGINS', 'DESTINATIONS'), default=(None, 4096),
+                        help="Zones per origin block and per destination block of the tiles (default: derived, 4096)")
+    parser.add_argument('--report', help="Write a JSON run report with the time, memory and sizes of every stage")
+    parser.add_argument('--profile', action='store_true', help="With --report, also profile the run with cProfile")
+    parser.add_argument('--trace-memory', action='store_true', help="With --report, also trace the Python allocations of every stage")
+    args = parser.parse_args(argv)
+    if args.zones and not args.zone_id:
+        parser.error("--zones requires --zone-id")
+
+    settings, scenarios = load_scenarios(args.config, args.scenario)
+    if args.list:
+        for scenario in scenarios:
+            print(f"{scenario['network']}\t{scenario.get('matrix', '')}\t{scenario['default_speed']} km/h")
+        return
+    if args.tiles is not None:
+        settings['n_tiles'] = args.tiles
+    if args.bbox is not None:
+        settings['region_bbox'] = tuple(args.bbox)
+    if args.sweep:
+        settings['run_sweep'] = True
+    if args.flows:
+        settings['flows_file'] = args.flows
+    if args.no_csv:
+        settings['write_csv'] = False
+
+    paths = {name: os.path.join(directory, '') for name, directory in
+             [('shape', args.shape_dir), ('input', args.input_dir), ('output', args.output_dir),
+              ('plots', args.plots_dir), ('cache', args.cache_dir or os.path.join(args.shape_dir, 'cache'))]}
+    _makedirs(paths['output'])
+    if args.plots:
+        _makedirs(paths['plots'])
+        os.environ.setdefault('MPLBACKEND', 'Agg')  # Only files are written, also on servers without a display
+
+    if args.report:
+        start_run_report(profile=args.profile, trace_memory=args.trace_memory, n_workers=args.workers, plots=list(args.plots),
+                         scenarios=[scenario['network'] for scenario in scenarios], settings=settings)
+
+    # The report is also written when a stage fails, with the error recorded in the run and its failed stages
+    try:
+        with stage('load_centroids') as record:
+            gdfCentroids = upload_centroids(paths['shape'], bbox=settings['region_bbox'], cache_dir=paths['cache'])
+            record['centroids'] = len(gdfCentroids)
+        if 'centroids' in args.plots:
+            with stage('plots'):
+                plot_gdf(gdfCentroids, paths['plots'] + "centroids.png")
+
+        if args.zones:
+            columns = [column for column in (args.zone_weight, args.zone_region) if column]
+            with stage('load_zones') as record:
+                gdfZones = upload_zones(args.zones, args.zone_id, columns=columns, bbox=settings['region_bbox'], cache_dir=paths['cache'])
+                record['zones'] = len(gdfZones)
+            if args.zone_region:
+                zone_regions, regions = gdfZones[args.zone_region].to_numpy(), None
+            else:
+                gdfPowiaty = read_layer(paths['shape'] + 'powiaty.shp', columns=['JPT_KOD_JE'], cache_dir=paths['cache'])
+                zone_regions = zones_to_regions(gdfZones, gdfPowiaty, 'JPT_KOD_JE')
+                powiaty_codes = list(gdfCentroids['JPT_KOD_JE'])
+                regions = powiaty_codes if set(zone_regions) <= set(powiaty_codes) else None  # In the order of the powiaty matrices
+            weights = gdfZones[args.zone_weight].to_numpy(dtype=np.float64) if args.zone_weight else None
+
+        for scenario in scenarios:
+            with stage(scenario['network']):
+                if args.zones:
+                    run_zone_scenario(scenario, gdfZones, args.zones, args.zone_id, settings, paths, zone_regions, weights=weights, regions=regions,
+                                      plots=args.plots, n_workers=args.workers, origin_block=args.tile_size[0], destination_block=args.tile_size[1])
+                else:
+                    run_scenario(scenario, gdfCentroids, settings, paths, plots=args.plots, n_workers=args.workers)
+    except BaseException as e:
+        if _run_report is not None:
+            _run_report['info']['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if args.report:
+            finish_run_report(args.report)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,7 +1,38 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import shapely
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PatchCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
+
+# County map of the renderer in the current (worker) process, see init_renderer
+_renderer = None
+
+
+@lru_cache(maxsize=None)
+def load_counties(shapefile_path):
+    """
+    Loads the county borders once per process; later calls return the same GeoDataFrame.
+    """
+
+    return gpd.read_file(shapefile_path)
+
+
+def colormap(color_scheme):
+    if color_scheme == 'green':
+        return plt.cm.viridis  # Use green colormap
+    elif color_scheme == 'grey':
+        return plt.colormaps['Greys']   # Use gray colormap
+    else:
+        raise ValueError("Invalid color_scheme. Choose 'gray' or 'green'.")
 
 def color_counties(shapefile_path, color_values, title, color_scheme = 'green', railway_gdf=None, write_path=None):
     """
@@ -11,8 +42,8 @@ def color_counties(shapefile_path, color_values, title, color_scheme = 'green',
     - shapefile_path: Path to the shapefile containing the administrative borders of counties.
     - color_values: List of numbers used to color the counties. The order should match the order of the counties in the shapefile.
     """
-    # Load the shapefile using GeoPandas
-    gdf = gpd.read_file(shapefile_path)
+    # Load the shapefile using GeoPandas (read only on the first call)
+    gdf = load_counties(shapefile_path).copy()
     
     # Ensure the color_values list is the same alength as the number of counties
     if len(color_values) != len(gdf):
@@ -22,12 +53,7 @@ def color_counties(shapefile_path, color_values, title, color_scheme = 'green',
     gdf['color_value'] = color_values
 
     # Set the colormap
-    if color_scheme == 'green':
-        cmap = plt.cm.viridis  # Use green colormap
-    elif color_scheme == 'grey':
-        cmap = plt.colormaps['Greys']   # Use gray colormap
-    else:
-        raise ValueError("Invalid color_scheme. Choose 'gray' or 'green'.")
+    cmap = colormap(color_scheme)
     
     # Normalize the color values to a colormap range
     norm = plt.Normalize(vmin=min(color_values), vmax=max(color_values))
@@ -55,6 +81,208 @@ def color_counties(shapefile_path, color_values, title, color_scheme = 'green',
     else:
         plt.show()
 
+def read_output_csv(csv_path):
+    """
+    Reads one output CSV of the model (a title line followed by one value per county).
+
+    Returns:
+    - title: The title line.
+    - values: NumPy array of the values.
+    """
+
+    csv_data = pd.read_csv(csv_path, header=0)
+    return csv_data.columns[0], csv_data.iloc[:, 0].to_numpy(dtype=float)
+
+def output_path(csv_root, name):
+    """
+    Returns the path of an output file, matching the file name case-insensitively
+    (the model writes e.g. ctf1_AvDistRail.csv for the plot 'avDistRail').
+    """
+
+    files = {f.lower(): f for f in os.listdir(csv_root)}
+    return os.path.join(csv_root, files.get(name.lower(), name))
+
+def load_output_cube(csv_root, plots, scenarios=("fut", "ctf1", "ctf2", "ctf3")):
+    """
+    Reads the outputs of all plots and scenarios once into one labeled array.
+
+    Parameters:
+    - csv_root: Folder with the model outputs (<scenario>_<plot>.csv).
+    - plots: Names of the plots (indicators).
+    - scenarios: Names of the scenarios; the first one is the baseline of the relative changes.
+
+    Returns:
+    - cube: Dictionary with the values ('values', array of shape plot x scenario x county), the
+      labels of the axes ('plots', 'scenarios') and the titles of the files ('titles', plot x scenario).
+    """
+
+    values, titles = [], []
+    for plot in plots:
+        for scenario in scenarios:
+            title, plot_values = read_output_csv(output_path(csv_root, scenario + "_" + plot + ".csv"))
+            titles.append(title)
+            values.append(plot_values)
+
+    shape = (len(plots), len(scenarios))
+    return {'values': np.stack(values).reshape(shape + (-1,)), 'plots': list(plots), 'scenarios': list(scenarios),
+            'titles': np.array(titles, dtype=object).reshape(shape)}
+
+def relative_changes(cube):
+    """
+    Computes the relative changes of all scenarios to the baseline (the first scenario) in %,
+    as an array of shape plot x scenario x county (0 for the baseline itself).
+    """
+
+    return (cube['values'] / cube['values'][:, :1] - 1) * 100
+
+def summarize_changes(cube, changes, weights=None):
+    """
+    Computes the summary statistics of the relative changes over the counties for every plot
+    and scenario in one step.
+
+    Parameters:
+    - cube: Output cube as returned by load_output_cube.
+    - changes: Relative changes as returned by relative_changes.
+    - weights: Optional weights of the counties (e.g. population) for the national weighted mean.
+
+    Returns:
+    - summary: DataFrame indexed by plot and scenario with the mean, median, min, max and standard
+      deviation of the changes over the counties (and their weighted mean with weights).
+    """
+
+    stats = {
+        'mean': np.nanmean(changes, axis=2),
+        'median': np.nanmedian(changes, axis=2),
+        'min': np.nanmin(changes, axis=2),
+        'max': np.nanmax(changes, axis=2),
+        'std': np.nanstd(changes, axis=2),
+    }
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        valid = np.isfinite(changes)
+        stats['weighted_mean'] = np.where(valid, changes, 0) @ weights / (valid @ weights)
+
+    index = pd.MultiIndex.from_product([cube['plots'], cube['scenarios']], names=['plot', 'scenario'])
+    return pd.DataFrame({name: values.ravel() for name, values in stats.items()}, index=index)
+
+def comparison_table(cube, changes):
+    """
+    Returns the cube and the relative changes as a long table with one row per plot, scenario and county.
+    """
+
+    n_plots, n_scenarios, n_counties = cube['values'].shape
+    index = pd.MultiIndex.from_product([cube['plots'], cube['scenarios'], range(n_counties)], names=['plot', 'scenario', 'county'])
+    return pd.DataFrame({'value': cube['values'].ravel(), 'relative_change': changes.ravel()}, index=index)
+
+def _polygon_patches(geometries):
+    """
+    Converts the county geometries into one patch per polygon (with its holes) and
+    returns the county row of every patch.
+    """
+
+    parts, rows = shapely.get_parts(np.asarray(geometries), return_index=True)
+    patches = []
+    for polygon in parts:
+        rings = [polygon.exterior, *polygon.interiors]
+        patches.append(PathPatch(Path.make_compound_path(*[Path(shapely.get_coordinates(ring), closed=True) for ring in rings])))
+    return patches, rows
+
+def init_renderer(shapefile_path, overlays=None):
+    """
+    Prepares the county map of the current process: the counties are loaded once and the figure,
+    the polygon collection, the colorbar and the overlay line layers are built once, so every map
+    only swaps the values, the colormap and the visible overlay (see render_map). The figure is
+    drawn with the Agg canvas, independently of the pyplot backend.
+
+    Parameters:
+    - shapefile_path: Path to the shapefile containing the administrative borders of counties.
+    - overlays: Optional dictionary name -> GeoDataFrame of lines (e.g. a railway project) that
+      maps can show in red on top of the counties.
+    """
+
+    global _renderer
+
+    gdf = load_counties(shapefile_path)
+    fig = Figure(figsize=(10, 10))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+
+    patches, rows = _polygon_patches(gdf.geometry)
+    counties = PatchCollection(patches, linewidth=0.8, edgecolor='0.8')
+    counties.set_array(np.zeros(len(patches)))
+    ax.add_collection(counties)
+
+    layers = {}
+    for name, gdfLines in (overlays or {}).items():
+        lines = shapely.get_parts(np.asarray(gdfLines.to_crs(gdf.crs).geometry))
+        layers[name] = LineCollection([shapely.get_coordinates(line) for line in lines], colors='red', linewidths=1, visible=False)
+        ax.add_collection(layers[name])
+
+    # Same extent and aspect as GeoDataFrame.plot
+    xmin, ymin, xmax, ymax = gdf.total_bounds
+    ax.set_xlim(xmin - 0.05 * (xmax - xmin), xmax + 0.05 * (xmax - xmin))
+    ax.set_ylim(ymin - 0.05 * (ymax - ymin), ymax + 0.05 * (ymax - ymin))
+    ax.set_aspect(1 / np.cos(np.radians((ymin + ymax) / 2)) if gdf.crs is not None and gdf.crs.is_geographic else 'equal')
+
+    colorbar = fig.colorbar(counties, ax=ax)
+    _renderer = {'n_counties': len(gdf), 'rows': rows, 'figure': fig, 'axes': ax, 'counties': counties,
+                 'colorbar': colorbar, 'overlays': layers}
+
+def render_map(color_values, title, write_path, color_scheme='green', overlay=None):
+    """
+    Renders one map with the county map of init_renderer and saves it to write_path.
+
+    Parameters:
+    - color_values: Numbers used to color the counties, in the order of the counties in the shapefile.
+    - title: Title of the map.
+    - write_path: Path of the saved image.
+    - color_scheme: 'green' or 'grey'.
+    - overlay: Name of the overlay line layer to show, or None.
+    """
+
+    r = _renderer
+    color_values = np.asarray(color_values, dtype=float)
+    if len(color_values) != r['n_counties']:
+        raise ValueError("The length of the color_values list must match the number of counties in the shapefile.")
+
+    r['counties'].set_array(color_values[r['rows']])
+    r['counties'].set_cmap(colormap(color_scheme))
+    r['counties'].set_clim(np.nanmin(color_values), np.nanmax(color_values))
+    r['colorbar'].update_normal(r['counties'])
+    for name, layer in r['overlays'].items():
+        layer.set_visible(name == overlay)
+    r['axes'].set_title(title)
+
+    r['figure'].savefig(write_path, bbox_inches='tight')
+    print(f"Plot saved to {write_path}")
+
+def _render_job(job):
+    render_map(**job)
+
+def render_maps(shapefile_path, jobs, overlays=None, n_workers=None):
+    """
+    Renders a batch of maps, in parallel across processes.
+
+    Every worker process builds the county map once (see init_renderer) and then renders its share
+    of the jobs by swapping the values, the colormap and the overlay.
+
+    Parameters:
+    - shapefile_path: Path to the shapefile containing the administrative borders of counties.
+    - jobs: List of dictionaries with the arguments of render_map (color_values, title, write_path,
+      color_scheme, overlay).
+    - overlays: Dictionary name -> GeoDataFrame of the overlay line layers (see init_renderer).
+    - n_workers: Number of worker processes (default: the number of CPUs). 1 renders in the current process.
+    """
+
+    n_workers = min(n_workers or os.cpu_count(), len(jobs))
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_renderer, initargs=(shapefile_path, overlays)) as executor:
+            list(executor.map(_render_job, jobs))
+    else:
+        init_renderer(shapefile_path, overlays)
+        for job in jobs:
+            _render_job(job)
+
 def main():
 
     # Initiate
@@ -71,44 +299,35 @@ def main():
     gdf_pis_project = gpd.read_file(root_path + "poland-railways-proposed-pis.shp")
     gdf_ko_project = gpd.read_file(root_path + "KO.shp")
     scenarios = [gdf_y, gdf_pis_project, gdf_ko_project]
+    overlays = {"ctf" + str(i+1): scenario for i, scenario in enumerate(scenarios)}
+    jobs = []
     
+    # Load all counterfactual outputs once and compare the scenarios to the future baseline
+
+    cube = load_output_cube(csv_root, plots, scenarios=["fut"] + list(overlays))
+    changes = relative_changes(cube)
+    summary = summarize_changes(cube, changes)
+    print(summary)
+    summary.to_csv(csv_root + "scenario_summary.csv")
+    comparison_table(cube, changes).to_csv(csv_root + "scenario_comparison.csv")
+
     # Map counterfactuals
     
-    for plot in plots:
-        # Load the baseline CSV data
-        csv_path = csv_root + "fut_" + plot + ".csv"
-        csv_data_baseline = pd.read_csv(csv_path, header=0)
-
-        # Plot baseline future scenario in comparison to 2021
+    for p, plot in enumerate(plots):
         if (plot in ["rChange", "vChange", "qChange", "pChange"]):
-            write_path = write_root + "counterfactuals/economic_equilibrium/" + plot + "_future_vs_2021.png"
+            write_folder = write_root + "counterfactuals/economic_equilibrium/"
         else:
-            write_path = write_root + "counterfactuals/average_distance/" + plot + "_future_vs_2021.png"
-        print(csv_path)
-        print(write_path)
-        title = list(csv_data_baseline.columns)[0]
-        color_counties(powiaty_path, list(csv_data_baseline.iloc[:, 0]), title + " (%)", color_scheme = 'grey', write_path = write_path)
-        
-        for i, scenario in enumerate(scenarios):
-            # Load the CSV data
-            csv_path = csv_root + "ctf" + str(i+1) + "_" + plot + ".csv"
-            csv_data = pd.read_csv(csv_path, header=0)
-
-            if (plot in ["rChange", "vChange", "qChange", "pChange"]):
-                write_path = write_root + "counterfactuals/economic_equilibrium/" + plot + "_ctf" + str(i+1) + ".png"
-            else:
-                write_path = write_root + "counterfactuals/average_distance/" + plot + "_ctf" + str(i+1) + ".png"
-            print(csv_path)
-            print(write_path)
-            ctf_values = np.array(list(csv_data.iloc[:, 0]))
-            fut_values = np.array(list(csv_data_baseline.iloc[:, 0]))
-            print(plot)
-            relative_change = ((ctf_values/fut_values)-1)*100
-            relative_change = list(relative_change)
-            title = list(csv_data.columns)[0]
+            write_folder = write_root + "counterfactuals/average_distance/"
+
+        # Plot baseline future scenario in comparison to 2021
+        jobs.append({'color_values': cube['values'][p, 0], 'title': cube['titles'][p, 0] + " (%)", 'color_scheme': 'grey',
+                     'write_path': write_folder + plot + "_future_vs_2021.png"})
+
+        for s, scenario in enumerate(cube['scenarios'][1:], start=1):
             # Replace '2021' with 'future baseline'
-            title = title.replace('2021', 'future baseline')
-            color_counties(powiaty_path, relative_change, title + " (%)", color_scheme = 'grey', railway_gdf = scenario, write_path = write_path)
+            title = cube['titles'][p, s].replace('2021', 'future baseline')
+            jobs.append({'color_values': changes[p, s], 'title': title + " (%)", 'color_scheme': 'grey', 'overlay': scenario,
+                         'write_path': write_folder + plot + "_" + scenario + ".png"})
     
     # Map descriptives
 
@@ -116,15 +335,12 @@ def main():
     
     for descriptive in descriptives:
             # Load the CSV data
-            csv_path = csv_root + "MAP_" + descriptive + ".csv"
-            csv_data = pd.read_csv(csv_path, header=0)
-            
+            title, values = read_output_csv(output_path(csv_root, "MAP_" + descriptive + ".csv"))
             write_path = write_root + "descriptives/" + descriptive + ".png"
-            print(csv_path)
-            print(write_path)
-            title = list(csv_data.columns)[0]
-            values = list(csv_data.iloc[:, 0])
-            color_counties(powiaty_path, values, title, color_scheme = 'grey', write_path = write_path)
+            jobs.append({'color_values': values, 'title': title, 'color_scheme': 'grey', 'write_path': write_path})
+
+    # Render all maps, building the county map once per worker process
+    render_maps(powiaty_path, jobs, overlays=overlays)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,441 @@
+"""
+Streams the railway and highway ways of an OpenStreetMap extract (.osm.pbf) into the network
+shapefiles read by generate_transport_matrices.py, replacing the osmosis and QGIS steps of
+shape/README.md.
+
+The following modules need to be installed: numpy, pandas, geopandas, shapely, osmium.
+
+You can use:
+pip install numpy
+pip install pandas
+pip install geopandas
+pip install shapely
+pip install osmium
+pip install pyarrow (optional, for the GeoParquet output)
+
+Example (all networks of a snapshot in one pass):
+python osm_to_network.py poland-220101-internal.osm.pbf --snapshot 220101 --output-dir ../shape
+
+Check (converts the small sample in shape/fixtures to .osm.pbf, extracts it in chunks of one way and
+reads every output back through upload_shapefile of generate_transport_matrices.py):
+python osm_to_network.py ../shape/fixtures/osm_to_network_sample.osm --snapshot sample --output-dir sample-check --chunk-size 1 --check
+
+Memory: the ways of every network are written to the output files in chunks of --chunk-size ways while
+the extract is streamed, and for .pbf input the node locations are kept in a temporary file-backed
+index (sparse_file_array) in the output directory, so the memory use does not grow with the extract.
+
+"""
+
+import argparse
+import json
+import os
+import re
+import tempfile
+from array import array
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+
+# Tag filters of the networks, as in the osmosis commands of shape/README.md: every preset maps
+# an OSM key to the accepted values (None accepts every value)
+ROAD_CLASSES = ('motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link',
+                'secondary', 'secondary_link', 'tertiary', 'tertiary_link')
+
+PRESETS = {
+    'railway-rail': ('railway', {'rail'}),
+    'railway-construction': ('railway', {'construction'}),
+    'railway-proposed': ('railway', {'proposed'}),
+    'highway-roads': ('highway', set(ROAD_CLASSES)),
+    'highway-construction': ('highway', {'construction'}),
+    'highway-proposed': ('highway', {'proposed'}),
+}
+
+# Number of ways of a network collected in memory before they are written to the output files
+CHUNK_WAYS = 100000
+
+# Speeds in km/h of the implicit maxspeed values used in Poland (e.g. maxspeed=PL:urban)
+IMPLICIT_SPEEDS = {'urban': 50, 'rural': 90, 'expressway': 120, 'motorway': 140, 'living_street': 20, 'walk': 5}
+
+
+def parse_maxspeed(value):
+    """
+    Converts an OSM maxspeed value into km/h.
+
+    Parameters:
+    - value: The maxspeed tag value, e.g. '90', '50 mph', 'PL:urban', '90;70', or None.
+
+    Returns:
+    - speed: Speed in km/h, or np.nan if the value is missing or not understood. Of several
+      values separated by ';' the first one is used.
+    """
+
+    if not value:
+        return np.nan
+    value = value.split(';')[0].strip()
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*(mph|km/h|kmh)?', value)
+    if match:
+        speed = float(match.group(1))
+        return speed * 1.609344 if match.group(2) == 'mph' else speed
+    return float(IMPLICIT_SPEEDS.get(value.split(':')[-1], np.nan))
+
+
+
+
+class NetworkWayCollector(osmium.SimpleHandler if osmium is not None else object):
+    """
+    Collects the ways matching the presets while the extract is streamed.
+
+    Only the way coordinates and the few needed tags are kept, in flat arrays per preset. Whenever a
+    preset has chunk_size ways, they are passed to on_chunk(name, gdfNet) as a GeoDataFrame (see
+    ways_to_gdf) and dropped, so the memory use is bounded by the chunk size and not by the extract.
+    """
+
+    def __init__(self, presets, on_chunk, chunk_size=CHUNK_WAYS):
+        super().__init__()
+        self.presets = presets
+        self.keys = {key for key, values in presets.values()}
+        self.on_chunk = on_chunk
+        self.chunk_size = chunk_size
+        self.ways = {name: self._empty_ways() for name in presets}
+        self.emitted = set()
+
+    @staticmethod
+    def _empty_ways():
+        return {'x': array('d'), 'y': array('d'), 'length': array('q'), 'osm_id': array('q'), 'maxspeed': array('d'), 'type': []}
+
+    def way(self, w):
+        tags = w.tags
+        if not any(key in tags for key in self.keys):
+            return
+        matches = [name for name, (key, values) in self.presets.items() if key in tags and (values is None or tags[key] in values)]
+        if not matches:
+            return
+
+        x, y = array('d'), array('d')
+        for node in w.nodes:
+            if node.location.valid():
+                x.append(node.location.lon)
+                y.append(node.location.lat)
+        if len(x) < 2:
+            return
+
+        speed = parse_maxspeed(tags.get('maxspeed'))
+        for name in matches:
+            ways = self.ways[name]
+            ways['x'].extend(x)
+            ways['y'].extend(y)
+            ways['length'].append(len(x))
+            ways['osm_id'].append(w.id)
+            ways['maxspeed'].append(speed)
+            ways['type'].append(tags[self.presets[name][0]])
+            if len(ways['osm_id']) >= self.chunk_size:
+                self.flush(name)
+
+    def flush(self, name):
+        """
+        Passes the collected ways of one preset to on_chunk and drops them.
+        """
+
+        self.on_chunk(name, ways_to_gdf(self.ways[name]))
+        self.ways[name] = self._empty_ways()
+        self.emitted.add(name)
+
+    def finish(self):
+        """
+        Passes the remaining ways of every preset to on_chunk (an empty chunk for the presets
+        without any way, so that every network is written).
+        """
+
+        for name in self.presets:
+            if len(self.ways[name]['osm_id']) or name not in self.emitted:
+                self.flush(name)
+
+
+
+
+def ways_to_gdf(ways, crs=3035):
+    """
+    Builds the GeoDataFrame of the collected ways with one vectorized shapely call.
+
+    Returns:
+    - gdfNet: GeoDataFrame in crs with the columns 'osm_id', 'type' (the value of the preset key),
+      'maxspeed' (km/h, NaN where unknown, as upload_shapefile expects) and the LineString geometry.
+    """
+
+    coords = np.column_stack([np.frombuffer(ways['x'], dtype=np.float64), np.frombuffer(ways['y'], dtype=np.float64)])
+    lengths = np.frombuffer(ways['length'], dtype=np.int64)
+    lines = shapely.linestrings(coords, indices=np.repeat(np.arange(len(lengths)), lengths)) if len(lengths) else []
+
+    gdfNet = gpd.GeoDataFrame({'osm_id': np.frombuffer(ways['osm_id'], dtype=np.int64),
+                               'type': ways['type'],
+                               'maxspeed': np.frombuffer(ways['maxspeed'], dtype=np.float64)},
+                              geometry=lines, crs=4326)
+    return gdfNet.to_crs(epsg=crs)
+
+
+
+
+@contextmanager
+def node_location_index(pbf_path, index=None, index_dir=None):
+    """
+    Yields the libosmium node location index used to stream the extract.
+
+    Parameters:
+    - pbf_path: Path of the OSM extract.
+    - index: Index to use as it is (e.g. 'flex_mem' or 'sparse_file_array,nodes.idx'). By default, a
+      .pbf extract gets a file-backed 'sparse_file_array' in a temporary file of index_dir (removed
+      afterwards), so the locations of all nodes are not kept in memory; small .osm files use 'flex_mem'.
+    - index_dir: Directory of the temporary index file (the system temporary directory by default).
+    """
+
+    if index is not None:
+        yield index
+    elif not pbf_path.endswith('.pbf'):
+        yield 'flex_mem'
+    else:
+        fd, path = tempfile.mkstemp(suffix='.nodes', dir=index_dir)
+        os.close(fd)
+        try:
+            yield f'sparse_file_array,{path}'
+        finally:
+            os.remove(path)
+
+
+
+
+def stream_osm_networks(pbf_path, on_chunk, presets=None, index=None, index_dir=None, chunk_size=CHUNK_WAYS):
+    """
+    Streams the extract once and passes the ways of all requested presets to on_chunk in chunks.
+
+    Parameters:
+    - pbf_path: Path of the OSM extract (.osm.pbf, or .osm for small local files).
+    - on_chunk: Function on_chunk(name, gdfNet) called with every chunk of at most chunk_size ways of
+      a preset, as returned by ways_to_gdf; every preset gets at least one (possibly empty) chunk.
+    - presets: Names of the presets from PRESETS (all of them by default).
+    - index, index_dir: libosmium node location index, see node_location_index.
+    - chunk_size: Number of ways of a preset kept in memory before they are passed to on_chunk.
+    """
+
+    if osmium is None:
+        raise ImportError("The osmium module is required to read OSM extracts: pip install osmium")
+
+    presets = list(PRESETS) if presets is None else list(presets)
+    unknown = [name for name in presets if name not in PRESETS]
+    if unknown:
+        raise ValueError(f"Unknown presets {unknown}. Choose from {list(PRESETS)}.")
+
+    print(f"Streaming {pbf_path}")
+    collector = NetworkWayCollector({name: PRESETS[name] for name in presets}, on_chunk, chunk_size=chunk_size)
+    with node_location_index(pbf_path, index, index_dir) as idx:
+        collector.apply_file(pbf_path, locations=True, idx=idx)
+    collector.finish()
+
+
+
+
+def read_osm_networks(pbf_path, presets=None, index=None):
+    """
+    Streams the extract once and returns the networks of all requested presets in memory, for small
+    extracts (see extract_networks for the national ones).
+
+    Parameters:
+    - pbf_path: Path of the OSM extract (.osm.pbf, or .osm for small local files).
+    - presets: Names of the presets from PRESETS (all of them by default).
+    - index: libosmium node location index, see node_location_index.
+
+    Returns:
+    - networks: Dictionary preset name -> GeoDataFrame as returned by ways_to_gdf.
+    """
+
+    chunks = {}
+    stream_osm_networks(pbf_path, lambda name, gdfNet: chunks.setdefault(name, []).append(gdfNet), presets=presets, index=index)
+
+    networks = {}
+    for name, gdfChunks in chunks.items():
+        networks[name] = pd.concat(gdfChunks, ignore_index=True)
+        print(f"\t{name}: {len(networks[name])} ways.")
+    return networks
+
+
+
+
+class NetworkWriter:
+    """
+    Writes the networks as <prefix>-<preset>-<snapshot> in the requested formats ('shp' for
+    upload_shapefile, 'parquet' for GeoParquet), appending chunk by chunk.
+    """
+
+    def __init__(self, output_dir, prefix, snapshot, formats=('shp',)):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir, self.prefix, self.snapshot, self.formats = output_dir, prefix, snapshot, formats
+        self.counts = {}
+        self.parquet_writers = {}
+
+    def base(self, name):
+        return os.path.join(self.output_dir, f"{self.prefix}-{name}-{self.snapshot}")
+
+    def write(self, name, gdfNet):
+        """
+        Writes one chunk of a network, replacing the files of an earlier run with the first chunk.
+        """
+
+        base = self.base(name)
+        first = name not in self.counts
+        if 'shp' in self.formats:
+            gdfNet.to_file(base + '.shp', mode='w' if first else 'a')
+        if 'parquet' in self.formats:
+            self._write_parquet(name, base + '.parquet', gdfNet)
+        self.counts[name] = self.counts.get(name, 0) + len(gdfNet)
+
+    def _write_parquet(self, name, path, gdfNet):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # GeoParquet: the geometry as WKB with the 'geo' metadata of the format
+        table = pa.Table.from_pandas(pd.DataFrame(gdfNet.drop(columns=gdfNet.geometry.name))
+                                     .assign(geometry=shapely.to_wkb(np.asarray(gdfNet.geometry))), preserve_index=False)
+        geo = {'version': '1.0.0', 'primary_column': 'geometry',
+               'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['LineString'], 'crs': gdfNet.crs.to_json_dict()}}}
+        table = table.replace_schema_metadata({**table.schema.metadata, b'geo': json.dumps(geo).encode()})
+        if name not in self.parquet_writers:
+            self.parquet_writers[name] = pq.ParquetWriter(path, table.schema)
+        self.parquet_writers[name].write_table(table)
+
+    def close(self):
+        """
+        Closes the files and returns the list of the written ones.
+        """
+
+        for writer in self.parquet_writers.values():
+            writer.close()
+        paths = []
+        for name, count in self.counts.items():
+            paths.extend(self.base(name) + '.' + extension for extension in self.formats)
+            print(f"\t{name}: {count} ways saved to {self.base(name)}")
+        return paths
+
+
+
+
+def extract_networks(pbf_path, output_dir, prefix, snapshot, presets=None, formats=('shp',), index=None, chunk_size=CHUNK_WAYS):
+    """
+    Streams the extract once and writes the networks of all requested presets chunk by chunk (see
+    NetworkWriter), with the temporary node location index in output_dir (see node_location_index).
+
+    Returns:
+    - paths: List of the written files.
+    """
+
+    writer = NetworkWriter(output_dir, prefix, snapshot, formats=formats)
+    try:
+        stream_osm_networks(pbf_path, writer.write, presets=presets, index=index, index_dir=output_dir, chunk_size=chunk_size)
+    finally:
+        paths = writer.close()
+    return paths
+
+
+
+
+def osm_to_pbf(osm_path, pbf_path):
+    """
+    Converts an .osm file into .osm.pbf, so that a check on a small .osm sample runs the .pbf reader.
+    """
+
+    if osmium is None:
+        raise ImportError("The osmium module is required to read OSM extracts: pip install osmium")
+    writer = osmium.SimpleWriter(pbf_path)
+    try:
+        for entity in osmium.FileProcessor(osm_path):
+            writer.add(entity)
+    finally:
+        writer.close()
+
+
+
+
+def check_networks(networks, output_dir, prefix, snapshot, default_speed=90):
+    """
+    Reads the written shapefiles back through upload_shapefile of generate_transport_matrices.py
+    and compares them with the extracted networks.
+
+    Parameters:
+    - networks: Dictionary preset name -> GeoDataFrame, as returned by read_osm_networks.
+    - output_dir, prefix, snapshot: As passed to extract_networks.
+    - default_speed: Speed given by upload_shapefile to the ways without a maxspeed.
+
+    Raises:
+    - ValueError: If a shapefile does not match its network.
+    """
+
+    from generate_transport_matrices import upload_shapefile
+
+    for name, gdfNet in networks.items():
+        file = f"{prefix}-{name}-{snapshot}"
+        gdfRead = upload_shapefile(file, default_speed, output_dir + os.sep)
+
+        problems = []
+        if len(gdfRead) != len(gdfNet):
+            problems.append(f"{len(gdfRead)} ways instead of {len(gdfNet)}")
+        elif len(gdfNet):
+            if gdfRead.crs != gdfNet.crs:
+                problems.append(f"crs {gdfRead.crs} instead of {gdfNet.crs}")
+            if not (gdfRead.geom_type == 'LineString').all():
+                problems.append("geometries that are not LineStrings")
+            expected = gdfNet['maxspeed'].fillna(default_speed).to_numpy()
+            if not np.allclose(gdfRead['maxspeed'].to_numpy(dtype=float), expected):
+                problems.append("maxspeed values that differ from the extract")
+            if not np.allclose(gdfRead.length.to_numpy(), gdfNet.length.to_numpy()):
+                problems.append("geometries that differ from the extract")
+        if problems:
+            raise ValueError(f"{file}.shp: " + ", ".join(problems))
+        print(f"\tChecked {file}.shp: {len(gdfRead)} ways.")
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract railway and highway networks from an OSM extract.")
+    parser.add_argument('pbf_path', help="OSM extract, e.g. poland-220101-internal.osm.pbf")
+    parser.add_argument('--snapshot', help="Snapshot label of the output names, e.g. 220101 (default: taken from the file name)")
+    parser.add_argument('--prefix', default='poland', help="Prefix of the output names")
+    parser.add_argument('--output-dir', default='.', help="Directory of the output files")
+    parser.add_argument('--preset', action='append', choices=list(PRESETS), help="Network to extract (repeatable; default: all)")
+    parser.add_argument('--format', action='append', choices=['shp', 'parquet'], help="Output format (repeatable; default: shp)")
+    parser.add_argument('--index', help="Node location index, e.g. flex_mem (default: a temporary sparse_file_array in the output directory for .pbf input)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_WAYS, help="Ways of a network kept in memory before they are written")
+    parser.add_argument('--check', action='store_true',
+                        help="Run a small extract through the .pbf reader (converting an .osm file first), then read the shapefiles "
+                             "back through upload_shapefile and compare them with the extract read in memory")
+    args = parser.parse_args()
+
+    snapshot = args.snapshot
+    if snapshot is None:
+        name = os.path.basename(args.pbf_path).split('.')[0]
+        snapshot = name.split('-')[1] if name.count('-') >= 1 else name
+    formats = args.format or ('shp',)
+    if args.check and 'shp' not in formats:
+        parser.error("--check reads the shapefiles back; add --format shp")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pbf_path = args.pbf_path
+        if args.check and not pbf_path.endswith('.pbf'):
+            pbf_path = os.path.join(tmp, os.path.basename(pbf_path).split('.')[0] + '.osm.pbf')
+            osm_to_pbf(args.pbf_path, pbf_path)
+        extract_networks(pbf_path, args.output_dir, args.prefix, snapshot, presets=args.preset, formats=formats,
+                         index=args.index, chunk_size=args.chunk_size)
+
+    if args.check:
+        networks = read_osm_networks(args.pbf_path, presets=args.preset)
+        check_networks(networks, args.output_dir, args.prefix, snapshot)
+
+if __name__ == "__main__":
+    main()